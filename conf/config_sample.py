@@ -44,6 +44,12 @@ LISTEN_WS_TRANSPORT = None
 # Port used for secure WebSocket, 'None' for disabling WSS
 LISTEN_WSS_TRANSPORT = None
 
+# JSON codec used to decode requests and encode messages of the transports:
+# 'json', 'simplejson' or 'ujson', see stratum/json_codec.py.
+# With python 2.7, simplejson decodes faster and json encodes faster.
+JSON_DECODER = 'simplejson'
+JSON_ENCODER = 'json'
+
 # Hostname and credentials for one trusted Bitcoin node ("Satoshi's client").
 # Stratum uses both P2P port (which is 8333 already) and RPC port
 BITCOIN_TRUSTED_HOST = 'localhost'
@@ -87,3 +93,69 @@ CENTRAL_WALLET = 'mgjPZrmmpAVuetUBbokcaEm9uZqVAUFvAu'
 PREVHASH_REFRESH_INTERVAL = 30 # in sec
 MERKLE_REFRESH_INTERVAL = 60 # How often check memorypool
 COINBASE_EXTRAS = '/rsk_stratum/'
+
+# Duplicate share detection. One index is shared by all jobs of the current
+# block (prevhash), so it holds every share submitted since the last block:
+# about share rate * 600 shares, 3M at 5000 shares/sec. Up to
+# SUBMITS_INDEX_LIMIT of them are kept in a set (about 100 bytes per share),
+# further shares are packed (about 30 bytes per share) behind a bloom filter
+# of SUBMITS_BLOOM_BITS bits. Detection stays exact either way, give the filter
+# about 10 bits per share above the limit to keep lookups of new shares fast.
+# Set SUBMITS_BLOOM_BITS = 0 to keep all shares in the set.
+SUBMITS_INDEX_LIMIT = 1000000
+SUBMITS_BLOOM_BITS = 2**26 # 8 MB, enough for 6M shares per block
+
+# Log every share with difficulty above this value. Set None to disable.
+LOG_SHARE_DIFFICULTY = 100000
+
+# Rejected shares are logged one by one at DEBUG level only, a summary
+# of them by reason is logged at most once per this interval (in sec).
+REJECT_LOG_INTERVAL = 10
+
+# Number of worker processes decoding, checking for duplicates and hashing
+# submitted shares. 0 does it in the main process. Shares received in one
+# reactor iteration are sent to the workers in batches of at most
+# SHARE_VERIFIER_BATCH_SIZE shares. The main process still spends about
+# half of the CPU time per share of checking it inline (see
+# tools/bench_share_validation.py -p), so the pool at most doubles
+# the share rate, given a core per worker. On a single core it is slower
+# than checking shares inline. Scaling on multiple cores is not measured
+# yet, enable it only when share checking keeps the main process busy.
+SHARE_VERIFIER_PROCESSES = 0
+SHARE_VERIFIER_BATCH_SIZE = 1000
+
+# Number of listener processes accepting socket transport connections
+# on LISTEN_SOCKET_TRANSPORT (SO_REUSEPORT, Linux 3.9+). The main process
+# builds templates, ships jobs to them and submits blocks found by them.
+# Every process gets its own range of extranonce1 and its own share
+# verifier processes. Other transports stay in the main process.
+# 0 handles everything in the main process.
+LISTEN_PROCESSES = 0
+
+# Maximum number and age (in sec) of jobs kept for the current block.
+# Shares for older jobs are rejected as stale, the newest job is always kept.
+# With RSK_POLL_PERIOD = 2, 100 jobs cover more than 3 minutes of RSK refreshes.
+# Set 0 for no limit.
+MAX_JOBS_PER_PREVHASH = 100
+MAX_JOB_AGE = 300
+
+# New jobs are written to BROADCAST_CHUNK_SIZE connections per reactor
+# iteration, shares are processed between the chunks. Set 0 to write
+# to all connections at once. Jobs which don't clean previous ones are
+# not written to connections with more than BROADCAST_MAX_PENDING bytes
+# not sent yet, until they send all of them (0 disables the check).
+BROADCAST_CHUNK_SIZE = 1000
+BROADCAST_MAX_PENDING = 65536
+
+# Write new jobs to connections with the highest hashrate
+# (estimated from their accepted shares) first.
+BROADCAST_BY_HASHRATE = True
+
+# Templates registered within this time (in sec) after the first one
+# are announced by one broadcast of the newest template. New block
+# (clean jobs) templates are never delayed more than BROADCAST_COALESCE_CLEAN,
+# by default they are broadcast immediately together with refreshes
+# waiting for their window: every delay of a new block costs the miners
+# work on a stale block. Set 0 to broadcast every template immediately.
+BROADCAST_COALESCE_CLEAN = 0
+BROADCAST_COALESCE = 0.2
@@ -7,6 +7,7 @@ import merkletree
 import halfnode
 from mining.interfaces import Interfaces
 from coinbasetx import CoinbaseTransaction
+from submit_index import SubmitIndex
 from Crypto.Hash import SHA256
 
 # Remove dependency to settings, coinbase extras should be
@@ -20,13 +21,58 @@ witness_nonce = b'\0' * 0x20
 witness_magic = b'\xaa\x21\xa9\xed'
 
 class TxBlob(object):
-    def __init__(self):
-        self.data = ''
+    '''Transaction of getblocktemplate result, decoded once and shared
+    by all templates built from it. Hex form is produced only when
+    the block is submitted.'''
+
+    def __init__(self, hex_data=''):
+        self.data = binascii.unhexlify(hex_data)
     def serialize(self):
        return self.data
+    def serialize_hex(self):
+       return binascii.hexlify(self.data)
     def deserialize(self, data):
        self.data = data
 
+class TemplateTransactions(object):
+    '''Transactions of getblocktemplate result with everything derived
+    from them: merkle tree and witness commitment. It doesn't depend
+    on the coinbase, so it is built once and shared (read only)
+    by all templates created from the same getblocktemplate result.
+
+    txid_cache and wtxid_cache are optional merkletree.MerkleCache
+    instances kept between getblocktemplate results.'''
+
+    def __init__(self, data, txid_cache=None, wtxid_cache=None):
+        hashes = [None] + [ util.ser_uint256(int(t['hash'], 16)) for t in data['transactions'] ]
+        try:
+            txids = [None] + [ util.ser_uint256(int(t['txid'], 16)) for t in data['transactions'] ]
+            self.merkletree = merkletree.MerkleTree(txids, cache=txid_cache)
+        except KeyError:
+            self.merkletree = merkletree.MerkleTree(list(hashes), cache=wtxid_cache)
+
+        # Hex form of merkle branch used in mining.notify
+        self.merkle_branch = [ binascii.hexlify(x) for x in self.merkletree._steps ]
+
+        wmt = merkletree.MerkleTree(hashes, cache=wtxid_cache).withFirst(binascii.unhexlify('0000000000000000000000000000000000000000000000000000000000000000'))
+        witness = SHA256.new(SHA256.new(wmt + witness_nonce).digest()).digest()
+        commitment = b'\x6a' + struct.pack(">b", len(witness) + len(witness_magic)) + witness_magic + witness
+        try:
+            default_witness = data['default_witness_commitment']
+            commitment_check = binascii.unhexlify(default_witness)
+            if(commitment != commitment_check):
+                print("calculated witness does not match supplied one! This block probably will not be accepted!")
+                commitment = commitment_check
+        except KeyError:
+            pass
+        self.commitment = commitment
+        self.witness = commitment[6:]
+
+        self.vtx = tuple( TxBlob(tx['data']) for tx in data['transactions'] )
+
+        # Coinbases built for these transactions, see BlockTemplate.fill_from_rpc()
+        self.coinbases = {}
+
 class BlockTemplate(halfnode.CBlock):
     '''Template is used for generating new jobs for clients.
     Let's iterate extranonce1, extranonce2, ntime and nonce
@@ -38,6 +84,7 @@ class BlockTemplate(halfnode.CBlock):
         super(BlockTemplate, self).__init__()
 
         self.job_id = job_id
+        self.work_id = job_id # job_id of the first template with the same work
         self.timestamper = timestamper
         self.coinbaser = coinbaser
 
@@ -46,48 +93,50 @@ class BlockTemplate(halfnode.CBlock):
         self.timedelta = 0
         self.curtime = 0
         self.target = 0
+        self.target_bin = util.target_to_bin(0)
         self.rsk_target = 0
         self.witness = 0
         #self.coinbase_hex = None
         self.merkletree = None
+        self.transactions = None
         if rsk != None:
             self.rsk_flag = True
 
 
         self.broadcast_args = []
 
-        # List of 4-tuples (extranonce1, extranonce2, ntime, nonce)
-        # registers already submitted and checked shares
+        # Packed (extranonce1, extranonce2, ntime, nonce, work_id) keys
+        # of already submitted and checked shares
         # There may be registered also invalid shares inside!
-        self.submits = []
-
-    def fill_from_rpc(self, data):
-        '''Convert getblocktemplate result into BlockTemplate instance'''
-
-        commitment = None
-        txids = []
-        hashes = [None] + [ util.ser_uint256(int(t['hash'], 16)) for t in data['transactions'] ]
-        try:
-            txids = [None] + [ util.ser_uint256(int(t['txid'], 16)) for t in data['transactions'] ]
-            mt = merkletree.MerkleTree(txids)
-        except KeyError:
-            mt = merkletree.MerkleTree(hashes)
-
-        wmt = merkletree.MerkleTree(hashes).withFirst(binascii.unhexlify('0000000000000000000000000000000000000000000000000000000000000000'))
-        self.witness = SHA256.new(SHA256.new(wmt + witness_nonce).digest()).digest()
-        commitment = b'\x6a' + struct.pack(">b", len(self.witness) + len(witness_magic)) + witness_magic + self.witness
+        # TemplateRegistry replaces it with the index shared
+        # by all templates of the same prevhash.
+        self.submits = SubmitIndex()
+
+    def fill_from_rpc(self, data, transactions=None):
+        '''Convert getblocktemplate result into BlockTemplate instance.
+        transactions is TemplateTransactions built from the same data,
+        templates differing just in the coinbase (e.g. RSK refresh)
+        can share it. It is built from data when not given.'''
+
+        if transactions is None:
+            transactions = TemplateTransactions(data)
+        self.transactions = transactions
+        self.witness = transactions.witness
+
+        # Templates differing only in job_id (e.g. RSK refresh with
+        # unchanged RSK tag) share one coinbase. It is never modified
+        # but by finalize(), which serializes the block right after.
+        # Such templates announce the same work, so they share
+        # also work_id used for detecting duplicate submits.
+        key = (self.coinbase_transaction_class, data['height'], data['coinbasevalue'],
+               data['coinbaseaux']['flags'], data['rsk_header'])
         try:
-            default_witness = data['default_witness_commitment']
-            commitment_check = binascii.unhexlify(default_witness)
-            if(commitment != commitment_check):
-                print("calculated witness does not match supplied one! This block probably will not be accepted!")
-                commitment = commitment_check
+            (coinbase, self.work_id) = transactions.coinbases[key]
         except KeyError:
-            pass
-        self.witness = commitment[6:]
-
-        coinbase = self.coinbase_transaction_class(self.timestamper, self.coinbaser, data['coinbasevalue'],
-                        data['coinbaseaux']['flags'], data['height'], commitment, settings.COINBASE_EXTRAS, data['rsk_header'])
+            coinbase = self.coinbase_transaction_class(self.timestamper, self.coinbaser, data['coinbasevalue'],
+                            data['coinbaseaux']['flags'], data['height'], transactions.commitment, settings.COINBASE_EXTRAS, data['rsk_header'])
+            self.work_id = self.job_id
+            transactions.coinbases[key] = (coinbase, self.work_id)
 
         self.height = data['height']
         self.nVersion = data['version']
@@ -97,35 +146,34 @@ class BlockTemplate(halfnode.CBlock):
         self.nTime = 0
         self.nNonce = 0
         self.vtx = [ coinbase, ]
-
-        for tx in data['transactions']:
-            t = TxBlob()
-            t.deserialize(binascii.unhexlify(tx['data']))
-            self.vtx.append(t)
+        self.vtx.extend(transactions.vtx)
 
         self.curtime = data['curtime']
         self.timedelta = self.curtime - int(self.timestamper.time())
-        self.merkletree = mt
+        self.merkletree = transactions.merkletree
         if settings.RSK_DEV_MODE:
             self.target = int(settings.BTC_DEV_TARGET)
         else:
             self.target = util.uint256_from_compact(self.nBits)
+        self.target_bin = util.target_to_bin(self.target)
 
         # Reversed prevhash
         self.prevhash_bin = binascii.unhexlify(util.reverse_hash(data['previousblockhash']))
         self.prevhash_hex = "%064x" % self.hashPrevBlock
 
+        # Fixed parts of the header, already in the byte order used for hashing
+        self.header_prefix_le = struct.pack("<i", self.nVersion) + util.ser_uint256(self.hashPrevBlock)
+        self.header_nbits_le = struct.pack("<I", self.nBits)
+
         self.broadcast_args = self.build_broadcast_args('rsk_flag' in data)
 
     def register_submit(self, extranonce1, extranonce2, ntime, nonce):
         '''Client submitted some solution. Let's register it to
-        prevent double submissions.'''
+        prevent double submissions. The same share submitted
+        under another job with the same work is a duplicate too.'''
 
-        t = (extranonce1, extranonce2, ntime, nonce)
-        if t not in self.submits:
-            self.submits.append(t)
-            return True
-        return False
+        # All parts but work_id have fixed width, so plain concatenation is unambiguous
+        return self.submits.add(extranonce1 + extranonce2 + ntime + nonce + self.work_id)
 
     def build_broadcast_args(self, rsk_job=False):
         '''Build parameters of mining.notify call. All clients
@@ -137,7 +185,7 @@ class BlockTemplate(halfnode.CBlock):
         job_id = self.job_id
         prevhash = binascii.hexlify(self.prevhash_bin)
         (coinb1, coinb2) = [binascii.hexlify(x) for x in self.vtx[0]._serialized]
-        merkle_branch = [binascii.hexlify(x) for x in self.merkletree._steps]
+        merkle_branch = self.transactions.merkle_branch
         version = binascii.hexlify(struct.pack(">i", self.nVersion))
         nbits = binascii.hexlify(struct.pack(">I", self.nBits))
         ntime = binascii.hexlify(struct.pack(">I", self.curtime))
@@ -173,6 +221,14 @@ class BlockTemplate(halfnode.CBlock):
         
         return r
 
+    def serialize_header_le(self, merkle_root_bin, ntime_bin, nonce_bin):
+        '''Serialize header for calculating block hash, in little endian
+        byte order. Every 32bit word of the result is byte-swapped
+        against serialize_header(). merkle_root_bin is the binary merkle root,
+        ntime_bin and nonce_bin are in big endian form sent by the client.'''
+        return ''.join((self.header_prefix_le, merkle_root_bin, ntime_bin[::-1],
+                        self.header_nbits_le, nonce_bin[::-1]))
+
     def finalize(self, merkle_root_int, extranonce1_bin, extranonce2_bin, ntime, nonce):
         '''Take all parameters required to compile block candidate.
         self.is_valid() should return True then...'''
@@ -194,6 +250,10 @@ class BlockTemplate(halfnode.CBlock):
         r.append(util.ser_vector(self.vtx))
         return ''.join(r)
 
+    def serialize_hex(self):
+        '''Hex form of the block for submitblock.'''
+        return binascii.hexlify(self.serialize())
+
     def is_valid(self):
         self.calc_sha256()
         target = util.uint256_from_compact(self.nBits)
@@ -213,3 +273,50 @@ class BlockTemplate(halfnode.CBlock):
         if calcwitness != self.witness:
             return False
         return True
+
+def _test():
+    import time
+    from mining.interfaces import TimestamperInterface
+
+    class Coinbaser(object):
+        def get_script_pubkey(self):
+            return util.script_to_address('mgjPZrmmpAVuetUBbokcaEm9uZqVAUFvAu')
+
+        def get_coinbase_data(self):
+            return ''
+
+    Interfaces.set_timestamper(TimestamperInterface())
+    txs = []
+    for i in xrange(10):
+        h = util.doublesha(str(i))[::-1].encode('hex')
+        txs.append({'data': '00', 'hash': h, 'txid': h})
+    data = {'transactions': txs, 'coinbasevalue': 1250000000, 'coinbaseaux': {'flags': ''},
+            'height': 500000, 'version': 0x20000000, 'previousblockhash': '00' * 4 + 'ab' * 28,
+            'bits': '1d00ffff', 'curtime': int(time.time()), 'rsk_header': '11' * 32}
+    transactions = TemplateTransactions(data)
+    submits = SubmitIndex()
+    share = ('\xf8\0\0\x01', '\0\0\0\x02', struct.pack('>I', data['curtime']), '\0\0\0\x03')
+
+    def template(job_id, data):
+        t = BlockTemplate(Interfaces.timestamper, Coinbaser(), job_id)
+        t.fill_from_rpc(data, transactions)
+        t.submits = submits
+        return t
+
+    # RSK refresh with unchanged RSK tag announces the same work under new job_id
+    first = template('1', data)
+    refresh = template('2', data)
+    assert refresh.vtx[0] is first.vtx[0] and refresh.work_id == '1'
+    assert first.register_submit(*share)
+    assert not refresh.register_submit(*share)
+    assert not first.register_submit(*share)
+
+    # New RSK tag changes the coinbase, the same share is new work
+    changed = template('3', dict(data, rsk_header='22' * 32))
+    assert changed.vtx[0] is not first.vtx[0] and changed.work_id == '3'
+    assert changed.register_submit(*share)
+    assert not changed.register_submit(*share)
+    print 'OK'
+
+if __name__ == '__main__':
+    _test()
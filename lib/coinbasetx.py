@@ -56,7 +56,22 @@ class CoinbaseTransaction(halfnode.CTransaction):
             txout_commitment.scriptPubKey = commitment
             self.vout.append(txout_commitment)
         # Two parts of serialized coinbase, just put part1 + extranonce + part2 to have final serialized tx
-        self._serialized = super(CoinbaseTransaction, self).serialize().split(self.extranonce_placeholder)
+        self._serialized = self.serialize_parts()
+
+    def serialize_parts(self):
+        '''Serialize the transaction as two parts, the one before
+        and the one after extranonce. The split follows the scriptSig
+        template, so it is right even if outputs happen to contain
+        bytes equal to extranonce_placeholder.'''
+        tx_in = self.vin[0]
+        (part1, part2) = tx_in._scriptSig_template
+        script_size = len(part1) + self.extranonce_size + len(part2)
+
+        coinb1 = ''.join((struct.pack("<i", self.nVersion), util.ser_compact_size(len(self.vin)),
+                          tx_in.prevout.serialize(), util.ser_compact_size(script_size), part1))
+        coinb2 = ''.join((part2, struct.pack("<I", tx_in.nSequence), util.ser_vector(self.vout),
+                          struct.pack("<I", self.nLockTime)))
+        return (coinb1, coinb2)
 
     def set_extranonce(self, extranonce):
         if len(extranonce) != self.extranonce_size:
@@ -4,15 +4,26 @@ class ExtranonceCounter(object):
     '''Implementation of a counter producing
        unique extranonce across all pool instances.
        This is just dumb "quick&dirty" solution,
-       but it can be changed at any time without breaking anything.'''
+       but it can be changed at any time without breaking anything.
 
-    def __init__(self, instance_id):
+       Processes of one instance sharing the listening port
+       (see settings.LISTEN_PROCESSES) split the iterator into
+       'processes' ranges, process_index selects the range.'''
+
+    def __init__(self, instance_id, process_index=0, processes=1):
         if instance_id < 0 or instance_id > 31:
             raise Exception("Current ExtranonceCounter implementation needs an instance_id in <0, 31>.")
 
-        # Last 5 most-significant bits represents instance_id
+        if process_index < 0 or process_index >= processes:
+            raise Exception("ExtranonceCounter process_index %d out of <0, %d>." % (process_index, processes - 1))
+
+        # Last 5 most-significant bits represents instance_id,
+        # next bits represents process_index (none for one process).
         # The rest is just an iterator of jobs.
-        self.counter = instance_id << 27
+        range_bits = 27 - (processes - 1).bit_length()
+        self.start = (instance_id << 27) | (process_index << range_bits)
+        self.end = self.start + (1 << range_bits) - 1
+        self.counter = self.start
         self.size = struct.calcsize('>L')
 
     def get_size(self):
@@ -21,5 +32,7 @@ class ExtranonceCounter(object):
 
     def get_new_bin(self):
         self.counter += 1
+        if self.counter > self.end:
+            # Don't step into the range of another process or instance
+            self.counter = self.start + 1
         return struct.pack('>L', self.counter)
-
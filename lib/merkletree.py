@@ -15,11 +15,37 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from hashlib import sha256
+from itertools import izip
 from util import doublesha
 
+class MerkleCache(object):
+    '''Levels of the last tree built with this cache. The next tree
+    (e.g. template refresh with transactions appended or removed
+    from the end) takes nodes covering the unchanged beginning
+    of the transaction list from here and hashes only the rest.
+    A change in the middle of the list rehashes everything after it,
+    like building the tree without the cache.
+
+    Use one cache per kind of tree (txid and wtxid trees share no nodes).'''
+
+    def __init__(self):
+        self.levels = []
+        self.hits = 0
+        self.misses = 0
+
+def _common_prefix(a, b):
+    '''Number of leading items equal in both lists.'''
+    n = min(len(a), len(b))
+    if a[:n] == b[:n]:
+        return n
+    for (i, (x, y)) in enumerate(izip(a, b)):
+        if x != y:
+            return i
+
 class MerkleTree:
-    def __init__(self, data, detailed=False):
+    def __init__(self, data, detailed=False, cache=None):
         self.data = data
+        self.cache = cache
         self.recalculate(detailed)
         self._hash_steps = None
 
@@ -35,6 +61,10 @@ class MerkleTree:
             PreL = [None]
             StartL = 2
         Ll = len(L)
+        if self.cache is not None and not detailed:
+            (levels, old_levels) = ([], self.cache.levels)
+        else:
+            (levels, old_levels) = (None, [])
         if detailed or Ll > 1:
             while True:
                 if detailed:
@@ -44,8 +74,23 @@ class MerkleTree:
                 steps.append(L[1])
                 if Ll % 2:
                     L += [L[-1]]
-                L = PreL + [doublesha(L[i] + L[i + 1]) for i in range(StartL, Ll, 2)]
+                if levels is None:
+                    L = PreL + [doublesha(L[i] + L[i + 1]) for i in range(StartL, Ll, 2)]
+                else:
+                    # Nodes over the unchanged beginning of the level
+                    # are the same as in the last tree
+                    depth = len(levels)
+                    levels.append(L)
+                    reused = []
+                    if depth + 1 < len(old_levels):
+                        reused = old_levels[depth + 1][1:_common_prefix(L, old_levels[depth]) // 2]
+                    hashed = [doublesha(L[i] + L[i + 1]) for i in range(StartL + 2 * len(reused), Ll, 2)]
+                    self.cache.hits += len(reused)
+                    self.cache.misses += len(hashed)
+                    L = PreL + reused + hashed
                 Ll = len(L)
+        if levels is not None:
+            self.cache.levels = levels
         self._steps = steps
         self.detail = detail
 
@@ -99,5 +144,37 @@ def _test():
     print x
     print time.time() - s
 
+    # Cached trees must give the same branches as uncached ones
+    import random
+    rnd = random.Random(0)
+    cache = MerkleCache()
+    assert MerkleTree([None], cache=cache)._steps == []
+    assert MerkleTree(list(txes), cache=cache).withFirst(txes[0]) == mt.withFirst(txes[0])
+    hashes = [None] + [doublesha(str(i)) for i in range(1000)]
+    for n in range(50):
+        if n % 3 == 0:
+            hashes.append(doublesha('new %d' % n))
+        elif n % 3 == 1:
+            del hashes[rnd.randint(1, len(hashes) - 1)]
+        else:
+            del hashes[len(hashes) // 2:]
+            hashes += [doublesha('tail %d %d' % (n, i)) for i in range(rnd.randint(0, 600))]
+        assert MerkleTree(list(hashes), cache=cache)._steps == MerkleTree(list(hashes))._steps
+
+    # Appending transactions reuses all but the right edge of the tree
+    (hits, misses) = (cache.hits, cache.misses)
+    MerkleTree(list(hashes), cache=cache)
+    hashes.append(doublesha('last'))
+    MerkleTree(list(hashes), cache=cache)
+    print "cache hits %d, misses %d" % (cache.hits - hits, cache.misses - misses)
+
+    # Change at the beginning rehashes the tree, nothing more
+    (hits, misses) = (cache.hits, cache.misses)
+    del hashes[1]
+    MerkleTree(list(hashes), cache=cache)
+    full = MerkleCache()
+    MerkleTree(list(hashes), cache=full)
+    assert (cache.hits - hits, cache.misses - misses) == (0, full.misses)
+
 if __name__ == '__main__':
     _test()
@@ -37,6 +37,7 @@ class RootstockRPC(object):
         self.rsk_header = None
         self.rsk_last_header = None
         self.rsk_target = None
+        self.rsk_target_bin = None # rsk_target serialized by util.target_to_bin
         self.rsk_miner_fees = None
         self.rsk_parent_hash = None
         self.rsk_last_parent_hash = None
@@ -69,6 +70,7 @@ class RootstockRPC(object):
         self.rsk_header = None
         self.rsk_last_header = None
         self.rsk_target = None
+        self.rsk_target_bin = None # rsk_target serialized by util.target_to_bin
         self.rsk_miner_fees = None
         self.rsk_parent_hash = None
         self.rsk_last_parent_hash = None
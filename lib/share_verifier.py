@@ -0,0 +1,170 @@
+import os
+import sys
+import struct
+import cPickle
+from twisted.internet import reactor, defer, protocol
+
+from lib.exceptions import SubmitException
+
+import stratum.logger
+log = stratum.logger.get_logger('share_verifier')
+
+WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'share_worker.py')
+
+class ShareWorkerProtocol(protocol.ProcessProtocol):
+    '''Connection to one share_worker.py process.'''
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.outstanding = set() # Request ids sent to this worker
+        self._buffer = ''
+
+    def send(self, msg):
+        data = cPickle.dumps(msg, cPickle.HIGHEST_PROTOCOL)
+        self.transport.write(struct.pack('>I', len(data)) + data)
+
+    def outReceived(self, data):
+        self._buffer += data
+        while len(self._buffer) >= 4:
+            (size,) = struct.unpack('>I', self._buffer[:4])
+            if len(self._buffer) < size + 4:
+                return
+
+            results = cPickle.loads(self._buffer[4:size + 4])
+            self._buffer = self._buffer[size + 4:]
+            self.pool.results_received(self, results)
+
+    def errReceived(self, data):
+        log.error("Share worker: %s" % data.strip())
+
+    def processEnded(self, reason):
+        self.pool.worker_ended(self, reason)
+
+class ShareVerifierPool(object):
+    '''Parses, checks for duplicates and hashes submitted shares
+    in a pool of worker processes, so share checking is not limited
+    to the single reactor thread.
+
+    Template state is shipped to all workers once per job by add_job().
+    Shares queued by verify() during one reactor iteration are sent
+    in one frame per worker (batches of at most batch_size shares).
+    All shares of one extranonce1 go to the same worker, which keeps
+    their duplicate index (index_limit and bloom_bits, see SubmitIndex).
+    A respawned worker starts with an empty index.
+    Jobs dropped by drop_jobs() are queued with the shares, so workers
+    still know the jobs of shares submitted before the drop.'''
+
+    def __init__(self, processes, batch_size=1000, index_limit=0, bloom_bits=0):
+        self.processes = processes
+        self.batch_size = batch_size
+        self.args = [ str(index_limit), str(bloom_bits) ]
+        self.workers = [None] * processes # Worker of every extranonce1 slot
+        self.jobs = {} # job_id -> 'job' command, resent to respawned workers
+        self.queue = []
+        self.deferreds = {}
+        self.request_id = 0
+        self.flush_call = None
+        self.stopping = False
+
+        for slot in xrange(processes):
+            self._spawn(slot)
+
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        log.info("Started %d share verification processes" % processes)
+
+    def _spawn(self, slot):
+        worker = ShareWorkerProtocol(self)
+        reactor.spawnProcess(worker, sys.executable, [sys.executable, WORKER_PATH] + self.args, env=os.environ)
+        self.workers[slot] = worker
+
+        for msg in self.jobs.itervalues():
+            worker.send(msg)
+
+    def _broadcast(self, msg):
+        for worker in self.workers:
+            worker.send(msg)
+
+    def add_job(self, job):
+        '''Ship the part of BlockTemplate needed for checking shares to the workers.'''
+        (coinb1, coinb2) = job.vtx[0]._serialized
+        msg = ('job', job.job_id, job.work_id, job.prevhash_hex, coinb1, coinb2, job.merkletree._steps,
+               job.header_prefix_le, job.header_nbits_le)
+        self.jobs[job.job_id] = msg
+        self._broadcast(msg)
+
+    def drop_jobs(self, job_ids):
+        '''Workers don't need these jobs anymore.'''
+        for job_id in job_ids:
+            self.jobs.pop(job_id, None)
+        self.queue.append((None, job_ids))
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self.flush_call is None:
+            # Collect all shares received in this reactor iteration
+            self.flush_call = reactor.callLater(0, self.flush)
+
+    def verify(self, job_id, extranonce1_bin, extranonce2, ntime, nonce):
+        '''Takes extranonce2, ntime and nonce in hex form as submitted.
+        Returns Deferred which fires with (error, header_le, hash_bin),
+        see share_worker.check_shares().'''
+        self.request_id += 1
+        d = defer.Deferred()
+        self.deferreds[self.request_id] = d
+        self.queue.append((self.request_id, job_id, extranonce1_bin, extranonce2, ntime, nonce))
+        self._schedule_flush()
+        return d
+
+    def flush(self):
+        self.flush_call = None
+        (queue, self.queue) = (self.queue, [])
+
+        # Shares are sent in submit order, drops in between them
+        shares = []
+        for entry in queue:
+            if entry[0] is not None:
+                shares.append(entry)
+                continue
+
+            self._send_shares(shares)
+            shares = []
+            self._broadcast(('drop', entry[1]))
+        self._send_shares(shares)
+
+    def _send_shares(self, shares):
+        if not shares:
+            return
+
+        slots = [ [] for _ in xrange(self.processes) ]
+        for share in shares:
+            slots[hash(share[2]) % self.processes].append(share)
+
+        size = self.batch_size
+        for (worker, batch) in zip(self.workers, slots):
+            for start in xrange(0, len(batch), size):
+                chunk = batch[start:start + size]
+                worker.outstanding.update(share[0] for share in chunk)
+                worker.send(('verify', chunk))
+
+    def results_received(self, worker, results):
+        for (request_id, error, header_le, hash_bin) in results:
+            worker.outstanding.discard(request_id)
+            d = self.deferreds.pop(request_id, None)
+            if d is not None:
+                d.callback((error, header_le, hash_bin))
+
+    def worker_ended(self, worker, reason):
+        for request_id in worker.outstanding:
+            d = self.deferreds.pop(request_id, None)
+            if d is not None:
+                d.errback(SubmitException("Share verification failed"))
+        worker.outstanding.clear()
+
+        if not self.stopping and worker in self.workers:
+            log.error("Share worker ended (%s), starting new one" % reason.getErrorMessage())
+            self._spawn(self.workers.index(worker))
+
+    def stop(self):
+        self.stopping = True
+        for worker in self.workers:
+            worker.transport.closeStdin()
@@ -0,0 +1,115 @@
+'''Share checking worker process, spawned by share_verifier.ShareVerifierPool.
+
+It reads framed pickled commands from stdin and writes framed pickled
+results to stdout. Every frame is a 4-byte big endian length followed
+by the pickle. Commands are:
+
+  ('job', job_id, work_id, prevhash, coinb1, coinb2, merkle_steps, header_prefix_le, header_nbits_le)
+  ('drop', [job_id, ...])
+  ('verify', [(request_id, job_id, extranonce1_bin, extranonce2, ntime, nonce), ...])
+
+extranonce2, ntime and nonce are hex strings as submitted by the miner.
+Every 'verify' command is answered by one list of
+(request_id, error, header_le, hash_bin) tuples. error is None for
+hashed shares, otherwise the reason of the reject: 'malformed'
+(bad hex), 'duplicate' or 'stale_job' (job not known anymore),
+header_le and hash_bin are None then.
+
+Every worker keeps the duplicate index of the shares it gets, one
+per prevhash like TemplateRegistry does. The pool sends all shares
+of one extranonce1 to the same worker.
+Usage: share_worker.py [index_limit bloom_bits], see SubmitIndex.
+
+This module must not depend on Twisted or pool settings.'''
+
+import sys
+import struct
+import cPickle
+import binascii
+from hashlib import sha256
+
+from submit_index import SubmitIndex
+
+def hash_share(job, extranonce1_bin, extranonce2_bin, ntime_bin, nonce_bin):
+    '''Returns header in hashing byte order and its double-SHA256 hash.
+    It must give the same result as BlockTemplate.serialize_coinbase(),
+    MerkleTree.withFirst() and BlockTemplate.serialize_header_le() do.'''
+    (coinb1, coinb2, merkle_steps, header_prefix_le, header_nbits_le) = job
+
+    merkle_root_bin = sha256(sha256(coinb1 + extranonce1_bin + extranonce2_bin + coinb2).digest()).digest()
+    for s in merkle_steps:
+        merkle_root_bin = sha256(sha256(merkle_root_bin + s).digest()).digest()
+
+    header_le = ''.join((header_prefix_le, merkle_root_bin, ntime_bin[::-1],
+                         header_nbits_le, nonce_bin[::-1]))
+    return (header_le, sha256(sha256(header_le).digest()).digest())
+
+def read_frame(f):
+    head = f.read(4)
+    if len(head) < 4:
+        return None
+
+    (size,) = struct.unpack('>I', head)
+    return cPickle.loads(f.read(size))
+
+def write_frame(f, obj):
+    data = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+    f.write(struct.pack('>I', len(data)) + data)
+    f.flush()
+
+def check_shares(jobs, submits, shares):
+    '''Parses, checks for duplicates and hashes 'verify' shares,
+    returns their results in the same order.'''
+    results = []
+    for (request_id, job_id, extranonce1_bin, extranonce2, ntime, nonce) in shares:
+        job = jobs.get(job_id)
+        if job is None:
+            results.append((request_id, 'stale_job', None, None))
+            continue
+
+        try:
+            extranonce2_bin = binascii.unhexlify(extranonce2)
+            ntime_bin = binascii.unhexlify(ntime)
+            nonce_bin = binascii.unhexlify(nonce)
+        except TypeError:
+            results.append((request_id, 'malformed', None, None))
+            continue
+
+        # Same key as BlockTemplate.register_submit()
+        (work_id, prevhash) = job[:2]
+        if not submits[prevhash].add(extranonce1_bin + extranonce2_bin + ntime_bin + nonce_bin + work_id):
+            results.append((request_id, 'duplicate', None, None))
+            continue
+
+        results.append((request_id, None) + hash_share(job[2:], extranonce1_bin, extranonce2_bin, ntime_bin, nonce_bin))
+    return results
+
+def main(stdin, stdout, index_limit=0, bloom_bits=0):
+    jobs = {} # job_id -> (work_id, prevhash, coinb1, coinb2, merkle_steps, header_prefix_le, header_nbits_le)
+    submits = {} # prevhash -> SubmitIndex
+
+    while True:
+        msg = read_frame(stdin)
+        if msg is None:
+            # Pool closed our stdin
+            return
+
+        if msg[0] == 'job':
+            jobs[msg[1]] = msg[2:]
+            if msg[3] not in submits:
+                submits[msg[3]] = SubmitIndex(index_limit, bloom_bits)
+
+        elif msg[0] == 'drop':
+            for job_id in msg[1]:
+                jobs.pop(job_id, None)
+            # Duplicate index lives as long as some job of its block
+            live = set(job[1] for job in jobs.itervalues())
+            for prevhash in submits.keys():
+                if prevhash not in live:
+                    del submits[prevhash]
+
+        elif msg[0] == 'verify':
+            write_frame(stdout, check_shares(jobs, submits, msg[1]))
+
+if __name__ == '__main__':
+    main(sys.stdin, sys.stdout, *[ int(x) for x in sys.argv[1:3] ])
@@ -0,0 +1,159 @@
+class BloomFilter(object):
+    '''Fixed-size probabilistic set of binary keys.
+    It may report a key as present even if it wasn't added
+    (false positive), but never the other way around.'''
+
+    def __init__(self, size_bits, hashes=4):
+        if size_bits < 8:
+            raise Exception("Bloom filter needs at least 8 bits")
+
+        self.size = size_bits
+        self.hashes = hashes
+        self.bits = bytearray((size_bits + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing, both halves are taken from one 64bit hash
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        h1 = h & 0xFFFFFFFF
+        h2 = (h >> 32) | 1
+        size = self.size
+        return [ (h1 + i * h2) % size for i in xrange(self.hashes) ]
+
+    def add(self, key):
+        '''Set bits of the key. Returns False
+        when all of them were set already.'''
+        bits = self.bits
+        new = False
+        for p in self._positions(key):
+            mask = 1 << (p & 7)
+            if not bits[p >> 3] & mask:
+                bits[p >> 3] |= mask
+                new = True
+        return new
+
+    def __contains__(self, key):
+        bits = self.bits
+        for p in self._positions(key):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+class PackedKeys(object):
+    '''Exact set of binary keys of one width, kept compact: keys are
+    collected in a plain set and every run_size of them are sorted
+    and packed into one string, which is searched by bisection.
+    Adding is cheap, lookups in the packed runs are not.'''
+
+    def __init__(self, width, run_size=65536):
+        self.width = width
+        self.run_size = run_size
+        self.pending = set()
+        self.runs = []
+
+    def add(self, key):
+        pending = self.pending
+        pending.add(key)
+        if len(pending) >= self.run_size:
+            self.runs.append(''.join(sorted(pending)))
+            self.pending = set()
+
+    def __contains__(self, key):
+        if key in self.pending:
+            return True
+
+        width = self.width
+        for run in self.runs:
+            lo = 0
+            hi = len(run) // width
+            while lo < hi:
+                mid = (lo + hi) // 2
+                k = run[mid * width:(mid + 1) * width]
+                if k < key:
+                    lo = mid + 1
+                elif k > key:
+                    hi = mid
+                else:
+                    return True
+        return False
+
+class SubmitIndex(object):
+    '''Registry of already submitted shares. Keys are packed binary
+    strings (e.g. extranonce1 + extranonce2 + ntime + nonce + work_id),
+    so every lookup is a single hash probe.
+
+    Up to 'limit' keys are stored in a set. Further keys are stored
+    exactly, but packed (PackedKeys, about the key length per key instead
+    of a string object and a set slot), behind a bloom filter of
+    'bloom_bits' bits. The filter only tells which keys were surely not
+    submitted yet, so the slow lookup in the packed keys is needed
+    just for duplicates and the filter's false positives.
+    limit=0 or bloom_bits=0 keeps all keys in the set.'''
+
+    def __init__(self, limit=0, bloom_bits=0, bloom_hashes=4):
+        self.limit = limit
+        self.bloom_bits = bloom_bits
+        self.bloom_hashes = bloom_hashes
+        self.keys = set()
+        self.bloom = None # Allocated once the limit is reached
+        self.overflow = {} # Key length -> PackedKeys
+        self.overflow_count = 0
+
+    def add(self, key):
+        '''Register the key. Returns False if the key
+        has been registered already.'''
+        keys = self.keys
+        if key in keys:
+            return False
+
+        if self.limit and self.bloom_bits and len(keys) >= self.limit:
+            if self.bloom is None:
+                self.bloom = BloomFilter(self.bloom_bits, self.bloom_hashes)
+            packed = self.overflow.get(len(key))
+            if packed is None:
+                packed = self.overflow[len(key)] = PackedKeys(len(key))
+
+            if not self.bloom.add(key) and key in packed:
+                return False
+            packed.add(key)
+            self.overflow_count += 1
+            return True
+
+        keys.add(key)
+        return True
+
+    def __contains__(self, key):
+        if key in self.keys:
+            return True
+        if self.bloom is None or key not in self.bloom:
+            return False
+        packed = self.overflow.get(len(key))
+        return packed is not None and key in packed
+
+    def __len__(self):
+        return len(self.keys) + self.overflow_count
+
+def _test():
+    import os
+    import time
+    import struct
+
+    # Tiny filter saturates quickly, every lookup falls through to the packed keys
+    for bloom_bits in (2**25, 2**10):
+        index = SubmitIndex(1000, bloom_bits)
+        keys = [ struct.pack('>QQ', i, i * 2654435761) + '1' for i in xrange(200000) ]
+        keys += [ os.urandom(20) for _ in xrange(1000) ] # Other width
+        start = time.time()
+        for key in keys:
+            assert index.add(key), "False duplicate"
+        elapsed = time.time() - start
+
+        for key in keys[::97]:
+            assert not index.add(key)
+            assert key in index
+        assert struct.pack('>QQ', 1, 1) + '1' not in index
+        assert len(index) == len(keys)
+        print "bloom %9d bits: %d keys above limit in %.3f sec" % (bloom_bits, index.overflow_count, elapsed)
+    print 'OK'
+
+if __name__ == '__main__':
+    _test()
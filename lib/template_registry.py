@@ -1,11 +1,12 @@
-import weakref
+import collections
 import json
 import binascii
+import struct
 import jsonpickle
 import util
 import StringIO
 from stratum import settings
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from lib.exceptions import SubmitException
 from time import time
 
@@ -14,6 +15,9 @@ log = stratum.logger.get_logger('template_registry')
 
 from mining.interfaces import Interfaces
 from extranonce_counter import ExtranonceCounter
+from submit_index import SubmitIndex
+from block_template import TemplateTransactions
+from merkletree import MerkleCache
 
 class JobIdGenerator(object):
     '''Generate pseudo-unique job_id. It does not need to be absolutely unique,
@@ -39,11 +43,36 @@ class TemplateRegistry(object):
 
 
     def __init__(self, block_template_class, coinbaser, bitcoin_rpc, instance_id,
-                 on_template_callback, on_block_callback, rootstock_rpc=None):
+                 on_template_callback, on_block_callback, rootstock_rpc=None, share_verifier=None,
+                 process_index=0, processes=1):
         self.prevhashes = {}
-        self.jobs = weakref.WeakValueDictionary()
 
-        self.extranonce_counter = ExtranonceCounter(instance_id)
+        # Live jobs by job_id, pruned together with self.prevhashes
+        self.jobs = {}
+        self.max_jobs_per_prevhash = getattr(settings, 'MAX_JOBS_PER_PREVHASH', 0)
+        self.max_job_age = getattr(settings, 'MAX_JOB_AGE', 0)
+
+        # Recently dropped job ids, shares for them are rejected as stale
+        self.stale_jobs = collections.OrderedDict()
+
+        # One duplicate share index per prevhash, shared by all its templates.
+        # It holds all shares of the block, SUBMITS_INDEX_LIMIT and
+        # SUBMITS_BLOOM_BITS are sized for that.
+        self.submits = {}
+
+        # Counters of submitted shares, see count_submit()
+        self.submit_stats = collections.Counter()
+
+        # Serialized targets of share difficulties, see diff_to_target_bin()
+        self.target_cache = {}
+
+        # Shares above this difficulty are logged, mostly for debugging purposes
+        self.info_difficulty = getattr(settings, 'LOG_SHARE_DIFFICULTY', 100000)
+        if self.info_difficulty:
+            self.info_target_bin = self.diff_to_target_bin(self.info_difficulty)
+
+        # Processes sharing the listening port get distinct extranonce1 ranges
+        self.extranonce_counter = ExtranonceCounter(instance_id, process_index, processes)
         self.extranonce2_size = block_template_class.coinbase_transaction_class.extranonce_size \
                 - self.extranonce_counter.get_size()
 
@@ -54,12 +83,29 @@ class TemplateRegistry(object):
         self.on_block_callback = on_block_callback
         self.on_template_callback = on_template_callback
 
+        # Templates registered within these windows (in sec) are announced
+        # by one broadcast, see _schedule_template_callback()
+        self.coalesce_window_clean = getattr(settings, 'BROADCAST_COALESCE_CLEAN', 0)
+        self.coalesce_window = getattr(settings, 'BROADCAST_COALESCE', 0)
+        self.template_callback_call = None
+        self.template_callback_clean = False
+        self.coalesce_stats = collections.Counter()
+
+        # Optional ShareVerifierPool, hashes shares out of the reactor thread
+        self.share_verifier = share_verifier
+
         self.last_block = None
         self.update_in_progress = False
         self.last_update = None
         self.rsk_last_update = 0
         self.rsk_update_in_progress = False
         self.last_data = dict()
+        self.last_transactions = None # TemplateTransactions of last_data
+
+        # Merkle nodes of the last txid and wtxid trees, a refresh
+        # hashes only paths changed since the last getblocktemplate
+        self.txid_merkle_cache = MerkleCache()
+        self.wtxid_merkle_cache = MerkleCache()
         self.last_rsk_hash = ""
 
         # Create first block template on startup
@@ -83,21 +129,7 @@ class TemplateRegistry(object):
         not be used anymore.'''
 
         prevhash = block.prevhash_hex
-        if hasattr(block, 'rsk_flag'):
-            rsk_is_old_block = self.rootstock_rpc.rsk_parent_hash == self.rootstock_rpc.rsk_last_parent_hash
-
-        call = False
-        if hasattr(settings, 'RSK_NOTIFY_POLICY') and hasattr(block, 'rsk_flag') and settings.RSK_NOTIFY_POLICY is not 0:
-            if settings.RSK_NOTIFY_POLICY == 1:
-                if self.rootstock_rpc.rsk_notify:
-                    call = True
-            if settings.RSK_NOTIFY_POLICY == 2:
-                if not rsk_is_old_block:
-                    call = True
-        else:
-            # Everything is ready, let's broadcast jobs!
-            call = True
-        if not call:
+        if not self._check_notify_policy(block):
             return
 
         if prevhash in self.prevhashes.keys():
@@ -105,21 +137,45 @@ class TemplateRegistry(object):
         else:
             new_block = True
             self.prevhashes[prevhash] = []
+            self.submits[prevhash] = SubmitIndex(getattr(settings, 'SUBMITS_INDEX_LIMIT', 0),
+                                                 getattr(settings, 'SUBMITS_BLOOM_BITS', 0))
 
         # Blocks sorted by prevhash, so it's easy to drop
         # them on blockchain update
         self.prevhashes[prevhash].append(block)
+        block.submits = self.submits[prevhash]
 
-        # Weak reference for fast lookup using job_id
+        # Fast lookup using job_id
+        block.registered = Interfaces.timestamper.time()
         self.jobs[block.job_id] = block
+        self.stale_jobs.pop(block.job_id, None)
+
+        if self.share_verifier is not None:
+            self.share_verifier.add_job(block)
 
         # Use this template for every new request
         self.last_block = block
 
+        # Drop the oldest templates of current block above the limits,
+        # the newest one is always kept
+        templates = self.prevhashes[prevhash]
+        keep = len(templates)
+        if self.max_jobs_per_prevhash:
+            keep = min(keep, self.max_jobs_per_prevhash)
+        if self.max_job_age:
+            min_registered = block.registered - self.max_job_age
+            while keep > 1 and templates[-keep].registered < min_registered:
+                keep -= 1
+        if keep < len(templates):
+            self._drop_jobs(templates[:-keep])
+            del templates[:-keep]
+
         # Drop templates of obsolete blocks
         for ph in self.prevhashes.keys():
             if ph != prevhash:
+                self._drop_jobs(self.prevhashes[ph])
                 del self.prevhashes[ph]
+                del self.submits[ph]
 
         log.info("New template for %s" % prevhash)
 
@@ -128,11 +184,83 @@ class TemplateRegistry(object):
             # It is mostly important for share manager
             self.on_block_callback(prevhash)
 
-        self.on_template_callback(new_block)
+        self._schedule_template_callback(new_block)
 
         #from twisted.internet import reactor
         #reactor.callLater(10, self.on_block_callback, new_block)
 
+    def _check_notify_policy(self, block):
+        '''Returns True when the template should be registered
+        and announced, according to settings.RSK_NOTIFY_POLICY.'''
+        if hasattr(block, 'rsk_flag'):
+            rsk_is_old_block = self.rootstock_rpc.rsk_parent_hash == self.rootstock_rpc.rsk_last_parent_hash
+
+        call = False
+        if hasattr(settings, 'RSK_NOTIFY_POLICY') and hasattr(block, 'rsk_flag') and settings.RSK_NOTIFY_POLICY is not 0:
+            if settings.RSK_NOTIFY_POLICY == 1:
+                if self.rootstock_rpc.rsk_notify:
+                    call = True
+            if settings.RSK_NOTIFY_POLICY == 2:
+                if not rsk_is_old_block:
+                    call = True
+        else:
+            # Everything is ready, let's broadcast jobs!
+            call = True
+        return call
+
+    def _schedule_template_callback(self, new_block):
+        '''Call on_template_callback once for all templates registered
+        within the coalescing window after the first of them. A window
+        starts with the first template and is never extended, templates
+        of a new block shorten it to coalesce_window_clean.'''
+        window = self.coalesce_window_clean if new_block else self.coalesce_window
+        call = self.template_callback_call
+
+        if call is None:
+            if not window:
+                self.coalesce_stats['broadcasts'] += 1
+                self.on_template_callback(new_block)
+                return
+
+            self.template_callback_clean = new_block
+            self.template_callback_call = reactor.callLater(window, self._template_callback)
+            return
+
+        # Merge into the pending broadcast
+        self.coalesce_stats['coalesced'] += 1
+        self.template_callback_clean = self.template_callback_clean or new_block
+        if not window:
+            call.cancel()
+            self._template_callback()
+        elif call.getTime() > reactor.seconds() + window:
+            call.reset(window)
+
+    def _template_callback(self):
+        self.template_callback_call = None
+        self.coalesce_stats['broadcasts'] += 1
+        self.on_template_callback(self.template_callback_clean)
+
+    def get_coalesce_stats(self):
+        '''Returns number of template broadcasts and number
+        of templates merged into other broadcasts.'''
+        return dict(self.coalesce_stats)
+
+    def _drop_jobs(self, blocks):
+        '''Remove given templates from the job index.'''
+        job_ids = []
+        for block in blocks:
+            # job_id may be reused by a newer template already
+            if self.jobs.get(block.job_id) is block:
+                del self.jobs[block.job_id]
+                job_ids.append(block.job_id)
+                self.stale_jobs[block.job_id] = True
+
+        while len(self.stale_jobs) > 10000:
+            self.stale_jobs.popitem(last=False)
+
+        if self.share_verifier is not None and job_ids:
+            self.share_verifier.drop_jobs(job_ids)
+
     def _rsk_genheader(self, bhfmm):
         '''
         Helper function for generating the rsk header in the expected format
@@ -162,6 +290,7 @@ class TemplateRegistry(object):
             self.rootstock_rpc.rsk_target = int(settings.RSK_DEV_TARGET)
         else:
             self.rootstock_rpc.rsk_target = int(data['target'], 16)
+        self.rootstock_rpc.rsk_target_bin = util.target_to_bin(self.rootstock_rpc.rsk_target)
 
 
     def update_block(self):
@@ -188,12 +317,14 @@ class TemplateRegistry(object):
     def _update_block(self, data, id):
         start = Interfaces.timestamper.time()
         self.last_data = data
+        self.last_transactions = None
 
         template = self.block_template_class(Interfaces.timestamper, self.coinbaser, JobIdGenerator.get_new_id())
         
         data['rsk_header'] = None if self.rootstock_rpc is None else self.rootstock_rpc.rsk_header
         
-        template.fill_from_rpc(data)
+        self.last_transactions = TemplateTransactions(data, self.txid_merkle_cache, self.wtxid_merkle_cache)
+        template.fill_from_rpc(data, self.last_transactions)
         self.add_template(template)
 
         log.info("Update finished, %.03f sec, %d txes" % \
@@ -228,11 +359,13 @@ class TemplateRegistry(object):
                 self.rootstock_rpc.rsk_target = int(settings.RSK_DEV_TARGET)
             else:
                 self.rootstock_rpc.rsk_target = int(result['target'], 16)
+            self.rootstock_rpc.rsk_target_bin = util.target_to_bin(self.rootstock_rpc.rsk_target)
 
             self.last_data['rsk_target'] = self.rootstock_rpc.rsk_target
             self.last_data['rsk_header'] = self.rootstock_rpc.rsk_header
             self.last_data['rsk_notify'] = self.rootstock_rpc.rsk_notify
-            template.fill_from_rpc(self.last_data)
+            # Transactions didn't change, only the coinbase needs to be built
+            template.fill_from_rpc(self.last_data, self.last_transactions)
             self.add_template(template)
             start = Interfaces.timestamper.time()
             log.info(json.dumps({"uuid" : id, "rsk" : "[RSKLOG]", "tag" : "[RSK_BLOCK_RECEIVED_TEMPLATE]", "start" : start, "elapsed" : 0, "data" : self.last_block.__dict__['broadcast_args']})) #job_id
@@ -260,26 +393,62 @@ class TemplateRegistry(object):
         diff1 = 0x00000000ffff0000000000000000000000000000000000000000000000000000
         return diff1 / difficulty
 
-    def get_job(self, job_id):
-        '''For given job_id returns BlockTemplate instance or None'''
+    def diff_to_target_bin(self, difficulty):
+        '''Converts difficulty to target serialized by util.target_to_bin().
+        Results are cached, the cache is keyed by difficulty itself,
+        so connection changing its difficulty simply uses another entry.'''
         try:
-            j = self.jobs[job_id]
-        except:
-            log.info("Job id '%s' not found" % job_id)
-            return None
+            return self.target_cache[difficulty]
+        except KeyError:
+            pass
+
+        if len(self.target_cache) >= 1000:
+            # Connections use just a few distinct difficulties,
+            # don't let vardiff noise to grow the cache forever
+            self.target_cache.clear()
+
+        target_bin = util.target_to_bin(self.diff_to_target(difficulty))
+        self.target_cache[difficulty] = target_bin
+        return target_bin
+
+    def count_submit(self, result):
+        '''Count submitted share by its result, 'accepted'
+        or the reason why it has been rejected.'''
+        self.submit_stats[result] += 1
+
+    def get_submit_stats(self):
+        '''Returns number of accepted shares and
+        rejected shares per reject reason.'''
+        return dict(self.submit_stats)
+
+    def get_template_stats(self):
+        '''Returns number of live templates and estimated memory
+        used by them. Templates may share transactions, every
+        transaction is counted just once, by its serialized size.'''
+        tx_ids = set()
+        tx_bytes = 0
+        coinbase_ids = set()
+        coinbase_bytes = 0
+        for job in self.jobs.itervalues():
+            if id(job.vtx[0]) not in coinbase_ids:
+                coinbase_ids.add(id(job.vtx[0]))
+                coinbase_bytes += sum(len(x) for x in job.vtx[0]._serialized)
+            for tx in job.vtx[1:]:
+                if id(tx) not in tx_ids:
+                    tx_ids.add(id(tx))
+                    tx_bytes += len(tx.serialize())
+
+        return {'prevhashes': len(self.prevhashes),
+                'jobs': len(self.jobs),
+                'transactions': len(tx_ids),
+                'transactions_bytes': tx_bytes,
+                'coinbases': len(coinbase_ids),
+                'coinbase_bytes': coinbase_bytes,
+                'submits': sum(len(x) for x in self.submits.itervalues())}
 
-        # Now we have to check if job is still valid.
-        # Unfortunately weak references are not bulletproof and
-        # old reference can be found until next run of garbage collector.
-        if j.prevhash_hex not in self.prevhashes:
-            log.info("Prevhash of job '%s' is unknown" % job_id)
-            return None
-
-        if j not in self.prevhashes[j.prevhash_hex]:
-            log.info("Job %s is unknown" % job_id)
-            return None
-
-        return j
+    def get_job(self, job_id):
+        '''For given job_id returns BlockTemplate instance or None'''
+        return self.jobs.get(job_id)
 
     def submit_share(self, job_id, worker_name, extranonce1_bin, extranonce2, ntime, nonce,
                      difficulty):
@@ -291,43 +460,61 @@ class TemplateRegistry(object):
             - job_id, extranonce2, ntime, nonce - in hex form sent by the client
             - difficulty - decimal number from session, again no checks performed
             - submitblock_callback - reference to method which receive result of submitblock()
+
+           Returns (header_hex, block_hash_hex, on_submit, on_submit_rsk), or Deferred
+           firing with such tuple when shares are hashed by the share verifier.
         '''
-        global rsk_last_received_share_time
-        global rsk_submitted_shares
         start = Interfaces.timestamper.time()
-        logid = util.id_generator()
-        log.info(json.dumps({"rsk" : "[RSKLOG]", "tag" : "[SHARE_RECEIVED_START]", "uuid" : logid, "start" : start, "elapsed" : 0}))
-        # Check if extranonce2 looks correctly. extranonce2 is in hex form...
+
+        # Cheap checks first. Malformed, stale and duplicate shares
+        # are rejected before any logging or hashing.
+
+        # Check if extranonce2, ntime and nonce look correctly. They are in hex form...
         if len(extranonce2) != self.extranonce2_size * 2:
+            self.count_submit('malformed')
             raise SubmitException("Incorrect size of extranonce2. Expected %d chars" % (self.extranonce2_size*2))
 
-        # Check for job
-        job = self.get_job(job_id)
-        if job == None:
-            raise SubmitException("Job '%s' not found" % job_id)
-
-        # Check if ntime looks correct
         if len(ntime) != 8:
+            self.count_submit('malformed')
             raise SubmitException("Incorrect size of ntime. Expected 8 chars")
 
-        if not job.check_ntime(int(ntime, 16)):
-            raise SubmitException("Ntime out of range")
-
-        # Check nonce
         if len(nonce) != 8:
+            self.count_submit('malformed')
             raise SubmitException("Incorrect size of nonce. Expected 8 chars")
 
+        # Check for job
+        job = self.get_job(job_id)
+        if job == None:
+            if job_id in self.stale_jobs:
+                self.count_submit('stale_job')
+                raise SubmitException("Stale job '%s'" % job_id)
+            self.count_submit('unknown_job')
+            raise SubmitException("Job '%s' not found" % job_id)
+
+        if self.share_verifier is not None:
+            return self._verify_share(job, extranonce1_bin, extranonce2, ntime, nonce, difficulty, start)
+
         # Convert from hex to binary
-        extranonce2_bin = binascii.unhexlify(extranonce2)
-        ntime_bin = binascii.unhexlify(ntime)
-        nonce_bin = binascii.unhexlify(nonce)
+        try:
+            extranonce2_bin = binascii.unhexlify(extranonce2)
+            ntime_bin = binascii.unhexlify(ntime)
+            nonce_bin = binascii.unhexlify(nonce)
+        except TypeError:
+            self.count_submit('malformed')
+            raise SubmitException("Incorrect hex encoding of extranonce2, ntime or nonce")
+
+        if not job.check_ntime(struct.unpack(">I", ntime_bin)[0]):
+            self.count_submit('ntime')
+            raise SubmitException("Ntime out of range")
 
         # Check for duplicated submit
         if not job.register_submit(extranonce1_bin, extranonce2_bin, ntime_bin, nonce_bin):
-            log.info("Duplicate from %s, (%s %s %s %s)" % \
-                    (worker_name, binascii.hexlify(extranonce1_bin), extranonce2, ntime, nonce))
+            self.count_submit('duplicate')
             raise SubmitException("Duplicate share")
 
+        logid = util.id_generator()
+        log.info(json.dumps({"rsk" : "[RSKLOG]", "tag" : "[SHARE_RECEIVED_START]", "uuid" : logid, "start" : start, "elapsed" : 0}))
+
         # Now let's do the hard work!
         # ---------------------------
 
@@ -337,79 +524,152 @@ class TemplateRegistry(object):
 
         # 2. Calculate merkle root
         merkle_root_bin = job.merkletree.withFirst(coinbase_hash)
-        merkle_root_int = util.uint256_from_str(merkle_root_bin)
 
-        # 3. Serialize header with given merkle, ntime and nonce
-        header_bin = job.serialize_header(merkle_root_int, ntime_bin, nonce_bin)
-
-        # 4. Reverse header and compare it with target of the user
-        
-        # header 80-bytes (19*4 + 4)
-        header_le = ''.join([header_bin[i*4:i*4+4][::-1] for i in range(0, 20)])
+        # 3. Serialize header with given merkle, ntime and nonce.
+        # Fixed parts are precomputed by the template, already reversed.
+        header_le = job.serialize_header_le(merkle_root_bin, ntime_bin, nonce_bin)
         hash_bin = util.doublesha(header_le)
-    
-        hash_int = util.uint256_from_str(hash_bin)
-        block_hash_hex = "%064x" % hash_int
-        header_hex = binascii.hexlify(header_bin)
+
+        return self._finish_share((header_le, hash_bin), job, extranonce1_bin, extranonce2_bin, ntime, nonce,
+                                  difficulty, start, logid)
+
+    def _finish_share(self, hashes, job, extranonce1_bin, extranonce2_bin, ntime, nonce, difficulty, start, logid):
+        '''Second part of submit_share(), called with (header_le, hash_bin)
+        of the share. Compares the hash with targets and submits block candidates.'''
+        (header_le, hash_bin) = hashes
+
+        # Reversed hash compares with targets serialized by util.target_to_bin()
+        # as a plain string, so there's no need to convert it to long
+        hash_be = hash_bin[::-1]
+        block_hash_hex = binascii.hexlify(hash_be)
+
+        # header 80-bytes (19*4 + 4), big endian words as reported to share manager
+        header_hex = binascii.hexlify(struct.pack(">20I", *struct.unpack("<20I", header_le)))
 
         log.info(json.dumps({"rsk" : "[RSKLOG]", "tag" : "[SHARE_RECEIVED_HEX]", "uuid" : logid, "start" : Interfaces.timestamper.time(), "elapsed" : 0, "data" : block_hash_hex}))
 
+        # 4. Compare hash with target of the user
         if not settings.RSK_DEV_MODE:
-            target_user = self.diff_to_target(difficulty)
-            if hash_int > target_user:
+            if hash_be > self.diff_to_target_bin(difficulty):
+                self.count_submit('above_target')
                 raise SubmitException("Share is above target")
 
         # Mostly for debugging purposes
-        target_info = self.diff_to_target(100000)
-        if hash_int <= target_info:
-            log.info("Yay, share with diff above 100000")
+        if self.info_difficulty and hash_be <= self.info_target_bin:
+            log.info("Yay, share with diff above %s" % self.info_difficulty)
 
         # 5. Compare hash with target of the network
-        log.info("Hash_Int: %s, Job.Target %s" % (hash_int, job.target))
-        btc_solution = hash_int <= job.target
-        rsk_solution = False
-
-        if self.rootstock_rpc is not None:
-            rsk_solution = hash_int <= self.rootstock_rpc.rsk_target and self._is_rsk_tag_in_coinbase(coinbase_bin)
+        log.info("Hash: %s, Job.Target %s" % (block_hash_hex, binascii.hexlify(job.target_bin)))
+        btc_solution = hash_be <= job.target_bin
+        rsk_solution = self._is_rsk_solution(hash_be, job, extranonce1_bin, extranonce2_bin)
 
+        self.count_submit('accepted')
         on_submit_rsk = None
         on_submit = None
 
         if btc_solution or rsk_solution:
             log.info("We found a block candidate! %s" % block_hash_hex)
-            job.finalize(merkle_root_int, extranonce1_bin, extranonce2_bin, int(ntime, 16), int(nonce, 16))
-            
-            if btc_solution:
-                serialized = binascii.hexlify(job.serialize())
-                on_submit = self.bitcoin_rpc.submitblock(serialized)
-                log.info(json.dumps({"rsk" : "[RSKLOG]", "tag" : "[BTC_SUBMITBLOCK]", "uuid" : util.id_generator(), "start" : start, "elapsed" : Interfaces.timestamper.time(), "data" : block_hash_hex}))
-            
-            if rsk_solution:
-                if rsk_last_received_share_time is None:
-                    rsk_last_received_share_time = int(round(time() * 1000))
-                    rsk_submitted_shares = 0
-                last_received_share_time_now = int(round(time() * 1000))
-                if last_received_share_time_now - rsk_last_received_share_time >= 1000:
-                    rsk_submitted_shares = 0
-                    rsk_last_received_share_time = last_received_share_time_now
-
-                if last_received_share_time_now - rsk_last_received_share_time < 1000 and rsk_submitted_shares < 3:
-                    rsk_submitted_shares += 1
-                else:
-                    return (header_hex, block_hash_hex, on_submit, on_submit_rsk)
-
-                serialized = binascii.hexlify(job.serialize())
-
-                block_header_hex = binascii.hexlify(header_le)
-                coinbase_hex = binascii.hexlify(coinbase_bin)
-                coinbase_hash_hex = binascii.hexlify(coinbase_hash)
-                merkle_hashes_array = [binascii.hexlify(x) for x in job.merkletree._steps]
-                merkle_hashes_array.insert(0, coinbase_hash_hex)
-                merkle_hashes = ' '.join(merkle_hashes_array)
-                txn_count = hex(len(merkle_hashes_array))[2:]
-
-                on_submit_rsk = self.rootstock_rpc.submitBitcoinBlockPartialMerkle(block_hash_hex, block_header_hex, coinbase_hex, merkle_hashes, txn_count)
-
-                log.info(json.dumps({"rsk" : "[RSKLOG]", "tag" : "[RSK_SUBMITBLOCK]", "uuid" : util.id_generator(), "start" : start, "elapsed" : Interfaces.timestamper.time(), "data" : block_hash_hex}))
-           
-        return (header_hex, block_hash_hex, on_submit, on_submit_rsk)
\ No newline at end of file
+            (on_submit, on_submit_rsk) = self.submit_block_candidate(job, header_le, extranonce1_bin, extranonce2_bin,
+                                                                     ntime, nonce, btc_solution, rsk_solution,
+                                                                     block_hash_hex, start)
+
+        return (header_hex, block_hash_hex, on_submit, on_submit_rsk)
+
+    def _verify_share(self, job, extranonce1_bin, extranonce2, ntime, nonce, difficulty, start):
+        '''Rest of submit_share() with the share verifier. Worker processes
+        decode the share, check it for duplicates and hash it.'''
+        try:
+            ntime_int = int(ntime, 16)
+        except ValueError:
+            self.count_submit('malformed')
+            raise SubmitException("Incorrect hex encoding of extranonce2, ntime or nonce")
+
+        if not job.check_ntime(ntime_int):
+            self.count_submit('ntime')
+            raise SubmitException("Ntime out of range")
+
+        logid = util.id_generator()
+        log.info(json.dumps({"rsk" : "[RSKLOG]", "tag" : "[SHARE_RECEIVED_START]", "uuid" : logid, "start" : start, "elapsed" : 0}))
+
+        d = self.share_verifier.verify(job.job_id, extranonce1_bin, extranonce2, ntime, nonce)
+        d.addCallbacks(self._share_verified, self._share_not_verified,
+                       callbackArgs=(job, extranonce1_bin, extranonce2, ntime, nonce, difficulty, start, logid))
+        return d
+
+    def _share_verified(self, result, job, extranonce1_bin, extranonce2, ntime, nonce, difficulty, start, logid):
+        (error, header_le, hash_bin) = result
+        if error is not None:
+            # Rejected by the worker, see share_worker.check_shares()
+            self.count_submit(error)
+            if error == 'duplicate':
+                raise SubmitException("Duplicate share")
+            if error == 'stale_job':
+                raise SubmitException("Stale job '%s'" % job.job_id)
+            raise SubmitException("Incorrect hex encoding of extranonce2, ntime or nonce")
+
+        return self._finish_share((header_le, hash_bin), job, extranonce1_bin, binascii.unhexlify(extranonce2),
+                                  ntime, nonce, difficulty, start, logid)
+
+    def _share_not_verified(self, failure):
+        '''Worker process checking the share failed.'''
+        failure.trap(SubmitException)
+        self.count_submit('unverified')
+        return failure
+
+    def _is_rsk_solution(self, hash_be, job, extranonce1_bin, extranonce2_bin):
+        '''Share hash meets RSK target and the coinbase commits to the current RSK block.'''
+        if self.rootstock_rpc is None or self.rootstock_rpc.rsk_target_bin is None:
+            return False
+
+        return hash_be <= self.rootstock_rpc.rsk_target_bin and \
+                self._is_rsk_tag_in_coinbase(job.serialize_coinbase(extranonce1_bin, extranonce2_bin))
+
+    def submit_block_candidate(self, job, header_le, extranonce1_bin, extranonce2_bin, ntime, nonce,
+                               btc_solution, rsk_solution, block_hash_hex, start):
+        '''Finalize the job with the solution and submit it to bitcoind
+        and/or rskd. Returns (on_submit, on_submit_rsk), Deferreds
+        of the submissions or None for those not performed.'''
+        global rsk_last_received_share_time
+        global rsk_submitted_shares
+        on_submit_rsk = None
+        on_submit = None
+
+        merkle_root_int = util.uint256_from_str(header_le[36:68])
+        job.finalize(merkle_root_int, extranonce1_bin, extranonce2_bin, int(ntime, 16), int(nonce, 16))
+
+        if btc_solution:
+            serialized = job.serialize_hex()
+            on_submit = self.bitcoin_rpc.submitblock(serialized)
+            log.info(json.dumps({"rsk" : "[RSKLOG]", "tag" : "[BTC_SUBMITBLOCK]", "uuid" : util.id_generator(), "start" : start, "elapsed" : Interfaces.timestamper.time(), "data" : block_hash_hex}))
+
+        if rsk_solution:
+            if rsk_last_received_share_time is None:
+                rsk_last_received_share_time = int(round(time() * 1000))
+                rsk_submitted_shares = 0
+            last_received_share_time_now = int(round(time() * 1000))
+            if last_received_share_time_now - rsk_last_received_share_time >= 1000:
+                rsk_submitted_shares = 0
+                rsk_last_received_share_time = last_received_share_time_now
+
+            if last_received_share_time_now - rsk_last_received_share_time < 1000 and rsk_submitted_shares < 3:
+                rsk_submitted_shares += 1
+            else:
+                return (on_submit, on_submit_rsk)
+
+            serialized = job.serialize_hex()
+
+            block_header_hex = binascii.hexlify(header_le)
+            coinbase_bin = job.serialize_coinbase(extranonce1_bin, extranonce2_bin)
+            coinbase_hash = util.doublesha(coinbase_bin)
+            coinbase_hex = binascii.hexlify(coinbase_bin)
+            coinbase_hash_hex = binascii.hexlify(coinbase_hash)
+            merkle_hashes_array = [binascii.hexlify(x) for x in job.merkletree._steps]
+            merkle_hashes_array.insert(0, coinbase_hash_hex)
+            merkle_hashes = ' '.join(merkle_hashes_array)
+            txn_count = hex(len(merkle_hashes_array))[2:]
+
+            on_submit_rsk = self.rootstock_rpc.submitBitcoinBlockPartialMerkle(block_hash_hex, block_header_hex, coinbase_hex, merkle_hashes, txn_count)
+
+            log.info(json.dumps({"rsk" : "[RSKLOG]", "tag" : "[RSK_SUBMITBLOCK]", "uuid" : util.id_generator(), "start" : start, "elapsed" : Interfaces.timestamper.time(), "data" : block_hash_hex}))
+
+        return (on_submit, on_submit_rsk)
@@ -0,0 +1,475 @@
+'''Listener processes, see settings.LISTEN_PROCESSES.
+
+The main process builds templates from bitcoind and rskd as usual
+and ListenerPool spawns the listener processes. They run the same
+twistd command with STRATUM_LISTENER set to their index, accept
+socket transport connections on the shared port (SO_REUSEPORT)
+and check shares with RelayedTemplateRegistry. It gets every
+announced job from the main process, without the transactions.
+Block candidates are sent back, the main process finalizes them
+with its own template and submits them.
+
+Frames are a 4-byte big endian length followed by a pickle,
+like those of share_worker.py. The main process writes to fd 3
+of the listener and reads its fd 4, stdout and stderr are shared.
+Commands sent to listeners are:
+
+  ('job', seq, state, dropped_job_ids)  where state is built by template_state()
+  ('submitted', request_id, kind, result)
+  ('failed', request_id, kind, error_message)
+  ('dropped', request_id, kind)
+
+and commands sent by listeners:
+
+  ('update',)
+  ('released', seq)
+  ('candidate', request_id, job_id, extranonce1_bin, extranonce2_bin, ntime, nonce,
+   btc_solution, rsk_solution, block_hash_hex, start)
+
+kind is 'btc' or 'rsk', a candidate is answered for every solution
+it is. 'dropped' means the submission was not performed (RSK
+submissions are rate limited).
+
+Listeners get only announced jobs, so they don't prune jobs themselves.
+Every 'job' command lists announced jobs the main process dropped
+since the previous one, the listener drops them and confirms it
+by 'released' with the seq of the command. Main process keeps every
+announced job until all listeners released it, candidates sent before
+'released' always find their job.'''
+
+import os
+import sys
+import struct
+import cPickle
+import binascii
+from twisted.internet import reactor, defer, protocol, stdio
+
+from stratum.server import LISTENER_ENV
+from lib.exceptions import SubmitException
+from mining.interfaces import Interfaces
+
+import util
+import merkletree
+from block_template import BlockTemplate
+from template_registry import TemplateRegistry
+
+import stratum.logger
+log = stratum.logger.get_logger('template_relay')
+
+# Descriptors of the listener process
+LISTENER_IN_FD = 3
+LISTENER_OUT_FD = 4
+
+# BlockTemplate attributes copied to RelayedTemplate
+RELAYED_ATTRS = ('job_id', 'work_id', 'height', 'nVersion', 'hashPrevBlock', 'nBits', 'curtime', 'timedelta',
+                 'target', 'target_bin', 'prevhash_bin', 'prevhash_hex',
+                 'header_prefix_le', 'header_nbits_le', 'broadcast_args')
+
+def pack_frame(msg):
+    data = cPickle.dumps(msg, cPickle.HIGHEST_PROTOCOL)
+    return struct.pack('>I', len(data)) + data
+
+class FrameBuffer(object):
+    '''Collects received data, returns complete frames.'''
+
+    def __init__(self):
+        self._buffer = ''
+
+    def feed(self, data):
+        self._buffer += data
+        msgs = []
+        while len(self._buffer) >= 4:
+            (size,) = struct.unpack('>I', self._buffer[:4])
+            if len(self._buffer) < size + 4:
+                break
+
+            msgs.append(cPickle.loads(self._buffer[4:size + 4]))
+            self._buffer = self._buffer[size + 4:]
+        return msgs
+
+def template_state(block, rootstock_rpc):
+    '''Part of BlockTemplate needed for announcing the job and checking
+    shares, with RSK target and merged mining hash of the moment.'''
+    state = dict((name, getattr(block, name)) for name in RELAYED_ATTRS)
+    state['rsk_flag'] = hasattr(block, 'rsk_flag')
+    state['coinbase'] = block.vtx[0]._serialized
+    state['merkle_steps'] = block.merkletree._steps
+    if rootstock_rpc is None:
+        state['rsk'] = None
+    else:
+        state['rsk'] = (rootstock_rpc.rsk_target_bin, rootstock_rpc.rsk_blockhashformergedmining)
+    return state
+
+class ListenerProtocol(protocol.ProcessProtocol):
+    '''Connection to one listener process.'''
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.ended = False
+        self.released = 0 # seq of the last 'job' command processed by the listener
+        self._frames = FrameBuffer()
+
+    def send(self, msg):
+        if not self.ended:
+            self.transport.writeToChild(LISTENER_IN_FD, pack_frame(msg))
+
+    def childDataReceived(self, childFD, data):
+        for msg in self._frames.feed(data):
+            self.pool.command_received(self, msg)
+
+    def processEnded(self, reason):
+        self.ended = True
+        self.pool.listener_ended(self, reason)
+
+class ListenerPool(object):
+    '''Spawns listener processes and ships jobs announced by the main
+    process to them. Block candidates found by listeners are submitted
+    by the registry of the main process.
+
+    on_template() is the on_template_callback of TemplateRegistry,
+    it calls the given on_template_callback for connections
+    of the main process (other transports) as well.'''
+
+    def __init__(self, processes, on_template_callback):
+        self.on_template_callback = on_template_callback
+        self.listeners = {} # index -> ListenerProtocol
+        self.last_job = None # 'job' command, sent to respawned listeners
+        self.seq = 0 # of the last 'job' command
+        self.announced = {} # job_id -> template, until all listeners released it
+        self.dropping = {} # job_id -> seq of the 'job' command dropping it
+        self.stopping = False
+
+        for index in xrange(1, processes + 1):
+            self._spawn(index)
+
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        log.info("Started %d listener processes" % processes)
+
+    def _spawn(self, index):
+        if self.stopping:
+            return
+
+        listener = ListenerProtocol(self, index)
+        listener.released = self.seq # It gets just the last job
+        env = dict(os.environ)
+        env[LISTENER_ENV] = str(index)
+
+        # The same twistd command, never daemonized and without the pid file
+        args = [sys.executable] + sys.argv + ['--nodaemon', '--pidfile=']
+        reactor.spawnProcess(listener, sys.executable, args, env=env,
+                             childFDs={0: 0, 1: 1, 2: 2, LISTENER_IN_FD: 'w', LISTENER_OUT_FD: 'r'})
+        self.listeners[index] = listener
+
+        if self.last_job is not None:
+            listener.send(self.last_job)
+
+    def on_template(self, is_new_block):
+        self.on_template_callback(is_new_block)
+
+        registry = Interfaces.template_registry
+        block = registry.last_block
+        self.seq += 1
+        dropped = [ job_id for (job_id, job) in self.announced.iteritems()
+                    if registry.get_job(job_id) is not job and job_id not in self.dropping ]
+        for job_id in dropped:
+            self.dropping[job_id] = self.seq
+        self.announced[block.job_id] = block
+
+        self.last_job = ('job', self.seq, template_state(block, registry.rootstock_rpc), dropped)
+        for listener in self.listeners.itervalues():
+            listener.send(self.last_job)
+        self._release_jobs()
+
+    def _release_jobs(self):
+        '''Forget dropped jobs released by all listeners.'''
+        released = min([ listener.released for listener in self.listeners.itervalues() ] + [self.seq])
+        for (job_id, seq) in self.dropping.items():
+            if seq <= released:
+                del self.dropping[job_id]
+                del self.announced[job_id]
+
+    def command_received(self, listener, msg):
+        if msg[0] == 'candidate':
+            self.candidate_received(listener, *msg[1:])
+        elif msg[0] == 'released':
+            listener.released = msg[1]
+            self._release_jobs()
+        elif msg[0] == 'update':
+            Interfaces.template_registry.update_block()
+        else:
+            log.error("Unknown command '%s' of listener %d" % (msg[0], listener.index))
+
+    def candidate_received(self, listener, request_id, job_id, extranonce1_bin, extranonce2_bin, ntime, nonce,
+                           btc_solution, rsk_solution, block_hash_hex, start):
+        kinds = [ kind for (kind, solution) in (('btc', btc_solution), ('rsk', rsk_solution)) if solution ]
+        registry = Interfaces.template_registry
+
+        # Registry may have dropped the job already, listener not yet
+        job = self.announced.get(job_id)
+        if job is not None:
+            # The header hashed by the listener, built from the full template
+            coinbase_hash = util.doublesha(job.serialize_coinbase(extranonce1_bin, extranonce2_bin))
+            merkle_root_bin = job.merkletree.withFirst(coinbase_hash)
+            header_le = job.serialize_header_le(merkle_root_bin, binascii.unhexlify(ntime), binascii.unhexlify(nonce))
+            if binascii.hexlify(util.doublesha(header_le)[::-1]) != block_hash_hex:
+                job = None
+
+        if job is None:
+            log.error("Block candidate %s of listener %d doesn't match job '%s'" % (block_hash_hex, listener.index, job_id))
+            for kind in kinds:
+                listener.send(('failed', request_id, kind, "Job '%s' not found" % job_id))
+            return
+
+        log.info("Block candidate %s found by listener %d" % (block_hash_hex, listener.index))
+        results = registry.submit_block_candidate(job, header_le, extranonce1_bin, extranonce2_bin, ntime, nonce,
+                                                  btc_solution, rsk_solution, block_hash_hex, start)
+        for (kind, d) in zip(('btc', 'rsk'), results):
+            if kind not in kinds:
+                continue
+            if d is None:
+                listener.send(('dropped', request_id, kind))
+            else:
+                d.addCallbacks(self._submitted, self._submit_failed,
+                               callbackArgs=(listener, request_id, kind), errbackArgs=(listener, request_id, kind))
+
+    def _submitted(self, result, listener, request_id, kind):
+        listener.send(('submitted', request_id, kind, result))
+        return result
+
+    def _submit_failed(self, failure, listener, request_id, kind):
+        log.error("Submission of block candidate of listener %d failed: %s" % (listener.index, failure.getErrorMessage()))
+        listener.send(('failed', request_id, kind, failure.getErrorMessage()))
+
+    def listener_ended(self, listener, reason):
+        if self.listeners.get(listener.index) is listener:
+            del self.listeners[listener.index]
+            self._release_jobs()
+
+        if not self.stopping:
+            # Delayed, listener failing on startup would be respawned in a loop
+            log.error("Listener process %d ended (%s), starting new one" % (listener.index, reason.getErrorMessage()))
+            reactor.callLater(1, self._spawn, listener.index)
+
+    def stop(self):
+        self.stopping = True
+        for listener in self.listeners.itervalues():
+            if not listener.ended:
+                listener.transport.closeChildFD(LISTENER_IN_FD)
+
+class RelayedCoinbase(object):
+    '''Serialized coinbase parts, see CoinbaseTransaction.serialize_parts().'''
+
+    def __init__(self, serialized):
+        self._serialized = serialized
+
+class RelayedTemplate(BlockTemplate):
+    '''Job announced by the main process. It has everything
+    needed for announcing it and checking shares, but
+    not the transactions, so it cannot be finalized.'''
+
+    def __init__(self, timestamper, state):
+        super(RelayedTemplate, self).__init__(timestamper, None, state['job_id'], True if state['rsk_flag'] else None)
+        for name in RELAYED_ATTRS:
+            setattr(self, name, state[name])
+
+        self.vtx = [ RelayedCoinbase(state['coinbase']), ]
+        self.merkletree = merkletree.MerkleTree([None])
+        self.merkletree._steps = state['merkle_steps']
+
+class RootstockState(object):
+    '''RSK target and merged mining hash of the main process,
+    replaces RootstockRPC in RelayedTemplateRegistry.'''
+
+    def __init__(self, rsk_target_bin, rsk_blockhashformergedmining):
+        self.rsk_target_bin = rsk_target_bin
+        self.rsk_blockhashformergedmining = rsk_blockhashformergedmining
+
+class ProducerProtocol(protocol.Protocol):
+    '''Connection of a listener process to the main process.'''
+
+    def __init__(self, registry):
+        self.registry = registry
+        self._frames = FrameBuffer()
+
+    def send(self, msg):
+        self.transport.write(pack_frame(msg))
+
+    def dataReceived(self, data):
+        for msg in self._frames.feed(data):
+            self.registry.command_received(msg)
+
+    def connectionLost(self, reason):
+        log.error("Connection to the main process lost, stopping")
+        if reactor.running:
+            reactor.stop()
+
+class RelayedTemplateRegistry(TemplateRegistry):
+    '''TemplateRegistry of a listener process. Jobs are announced
+    as they come from the main process, which already applied
+    RSK notify policy and broadcast coalescing, and dropped when
+    the main process drops them. Block candidates and update
+    requests are sent to the main process.
+    on_load fires with the first job, connections can't be
+    served before it.'''
+
+    def __init__(self, instance_id, listener_index, listeners, on_template_callback, on_block_callback,
+                 share_verifier=None):
+        self.producer = ProducerProtocol(self)
+        stdio.StandardIO(self.producer, stdin=LISTENER_IN_FD, stdout=LISTENER_OUT_FD)
+        self.requests = {} # (request_id, kind) -> Deferred of the submission
+        self.request_id = 0
+        self.on_load = defer.Deferred()
+
+        # Main process uses the first extranonce1 range
+        super(RelayedTemplateRegistry, self).__init__(RelayedTemplate, None, None, instance_id,
+                                                      on_template_callback, on_block_callback, None,
+                                                      share_verifier, listener_index, listeners + 1)
+        self.coalesce_window_clean = 0
+        self.coalesce_window = 0
+        self.max_jobs_per_prevhash = 0
+        self.max_job_age = 0
+
+    def command_received(self, msg):
+        if msg[0] == 'job':
+            self.job_received(*msg[1:])
+            return
+
+        (command, request_id, kind) = msg[:3]
+        d = self.requests.pop((request_id, kind), None)
+        if d is None:
+            return
+
+        if command == 'submitted':
+            d.callback(msg[3])
+        elif command == 'failed':
+            d.errback(SubmitException(msg[3]))
+
+    def job_received(self, seq, state, dropped):
+        self.drop_relayed_jobs(dropped)
+        if state['rsk'] is None:
+            self.rootstock_rpc = None
+        else:
+            self.rootstock_rpc = RootstockState(*state['rsk'])
+        self.add_template(RelayedTemplate(Interfaces.timestamper, state))
+        self.producer.send(('released', seq))
+        if not self.on_load.called:
+            self.on_load.callback(True)
+
+    def drop_relayed_jobs(self, job_ids):
+        '''Drop jobs dropped by the main process.'''
+        job_ids = set(job_ids)
+        self._drop_jobs([ self.jobs[job_id] for job_id in job_ids if job_id in self.jobs ])
+        for templates in self.prevhashes.itervalues():
+            templates[:] = [ t for t in templates if t.job_id not in job_ids ]
+
+    def update_block(self):
+        '''Main process checks for new block, it ignores
+        the request when an update is in progress.'''
+        self.producer.send(('update',))
+
+    def _check_notify_policy(self, block):
+        return True
+
+    def submit_block_candidate(self, job, header_le, extranonce1_bin, extranonce2_bin, ntime, nonce,
+                               btc_solution, rsk_solution, block_hash_hex, start):
+        '''Send the candidate to the main process, which has the transactions.'''
+        self.request_id += 1
+        self.producer.send(('candidate', self.request_id, job.job_id, extranonce1_bin, extranonce2_bin, ntime, nonce,
+                            btc_solution, rsk_solution, block_hash_hex, start))
+
+        on_submit = None
+        on_submit_rsk = None
+        if btc_solution:
+            on_submit = self.requests[(self.request_id, 'btc')] = defer.Deferred()
+            on_submit.addErrback(self._submit_failed, block_hash_hex, False)
+        if rsk_solution:
+            on_submit_rsk = self.requests[(self.request_id, 'rsk')] = defer.Deferred()
+            on_submit_rsk.addErrback(self._submit_failed, block_hash_hex, True)
+        return (on_submit, on_submit_rsk)
+
+    def _submit_failed(self, failure, block_hash_hex, rsk):
+        '''Main process failed to submit the candidate (e.g. its job
+        is gone already), report it like a rejected submission.'''
+        failure.trap(SubmitException)
+        log.error("Submission of block candidate %s failed: %s" % (block_hash_hex, failure.getErrorMessage()))
+        if rsk:
+            return {'error': {'message': failure.getErrorMessage()}}
+        return False
+
+def _test():
+    import time
+    from mining.interfaces import TimestamperInterface
+
+    class Coinbaser(object):
+        def get_script_pubkey(self):
+            return util.script_to_address('mgjPZrmmpAVuetUBbokcaEm9uZqVAUFvAu')
+
+        def get_coinbase_data(self):
+            return ''
+
+    class BitcoinRPC(object):
+        def __init__(self):
+            self.submitted = []
+
+        def getblocktemplate(self):
+            return defer.succeed({'transactions': [], 'coinbasevalue': 1250000000, 'coinbaseaux': {'flags': ''},
+                                  'height': 500000, 'version': 0x20000000, 'previousblockhash': '00' * 4 + 'ab' * 28,
+                                  'bits': '207fffff', 'curtime': int(time.time())})
+
+        def submitblock(self, block_hex):
+            self.submitted.append(block_hex)
+            return defer.succeed(True)
+
+    class Listener(ListenerProtocol):
+        def __init__(self, pool, index):
+            ListenerProtocol.__init__(self, pool, index)
+            self.sent = []
+
+        def send(self, msg):
+            self.sent.append(msg)
+
+    def candidate(job, request_id):
+        (extranonce1_bin, extranonce2_bin, ntime, nonce) = ('\xf8\0\0\x01', '\0' * 4, '%08x' % job.curtime, '00000001')
+        coinbase_hash = util.doublesha(job.serialize_coinbase(extranonce1_bin, extranonce2_bin))
+        header_le = job.serialize_header_le(job.merkletree.withFirst(coinbase_hash), binascii.unhexlify(ntime), binascii.unhexlify(nonce))
+        block_hash_hex = binascii.hexlify(util.doublesha(header_le)[::-1])
+        return ('candidate', request_id, job.job_id, extranonce1_bin, extranonce2_bin, ntime, nonce,
+                True, False, block_hash_hex, 0)
+
+    Interfaces.set_timestamper(TimestamperInterface())
+    pool = ListenerPool(0, lambda is_new_block: None)
+    listener = pool.listeners[1] = Listener(pool, 1)
+    announce = [False]
+    rpc = BitcoinRPC()
+    registry = TemplateRegistry(BlockTemplate, Coinbaser(), rpc, 31,
+                                lambda is_new_block: announce[0] and pool.on_template(is_new_block), lambda prevhash: None, None)
+    Interfaces.set_template_registry(registry)
+    registry.max_jobs_per_prevhash = 2
+    registry.coalesce_window = 0
+
+    # Listener holds the first job, main process drops it
+    # with templates which are never announced
+    first = registry.last_block
+    pool.on_template(True)
+    for _ in xrange(3):
+        registry.update_block()
+    assert registry.get_job(first.job_id) is None
+    announce[0] = True
+    registry.update_block()
+    assert listener.sent[-1][3] == [first.job_id]
+
+    # Candidate sent before the listener processed the drop
+    pool.command_received(listener, candidate(first, 1))
+    assert len(rpc.submitted) == 1 and listener.sent[-1] == ('submitted', 1, 'btc', True)
+
+    # Listener released the job
+    pool.command_received(listener, ('released', listener.sent[-2][1]))
+    assert first.job_id not in pool.announced
+    pool.command_received(listener, candidate(first, 2))
+    assert len(rpc.submitted) == 1 and listener.sent[-1][:3] == ('failed', 2, 'btc')
+    assert pool.announced.keys() == [registry.last_block.job_id]
+    print 'OK'
+
+if __name__ == '__main__':
+    _test()
@@ -42,33 +42,24 @@ def ser_string(s):
         return chr(254) + struct.pack("<I", len(s)) + s
     return chr(255) + struct.pack("<Q", len(s)) + s
 
+UINT256_MASK = (1L << 256) - 1
+
+# Swaps byte order of each of eight 32bit words
+_words_le = struct.Struct("<8I")
+_words_be = struct.Struct(">8I")
+
 def deser_uint256(f):
-    r = 0L
-    for i in xrange(8):
-        t = struct.unpack("<I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    return uint256_from_str(f.read(32))
 
 def ser_uint256(u):
-    rs = ""
-    for i in xrange(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFFL)
-        u >>= 32
-    return rs
+    return binascii.unhexlify('%064x' % (u & UINT256_MASK))[::-1]
 
 def uint256_from_str(s):
-    r = 0L
-    t = struct.unpack("<IIIIIIII", s[:32])
-    for i in xrange(8):
-        r += t[i] << (i * 32)
-    return r
+    return int(binascii.hexlify(s[31::-1]), 16)
 
 def uint256_from_str_be(s):
-    r = 0L
-    t = struct.unpack(">IIIIIIII", s[:32])
-    for i in xrange(8):
-        r += t[i] << (i * 32)
-    return r
+    '''Eight big endian 32bit words, least significant word first'''
+    return uint256_from_str(_words_le.pack(*_words_be.unpack(s[:32])))
 
 def uint256_from_compact(c):
     nbytes = (c >> 24) & 0xFF
@@ -90,19 +81,21 @@ def deser_vector(f, c):
         r.append(t)
     return r
 
-def ser_vector(l):
-    r = ""
-    if len(l) < 253:
-        r = chr(len(l))
-    elif len(l) < 0x10000:
-        r = chr(253) + struct.pack("<H", len(l))
-    elif len(l) < 0x100000000L:
-        r = chr(254) + struct.pack("<I", len(l))
+def ser_compact_size(n):
+    if n < 253:
+        return chr(n)
+    elif n < 0x10000:
+        return chr(253) + struct.pack("<H", n)
+    elif n < 0x100000000L:
+        return chr(254) + struct.pack("<I", n)
     else:
-        r = chr(255) + struct.pack("<Q", len(l))
+        return chr(255) + struct.pack("<Q", n)
+
+def ser_vector(l):
+    r = [ ser_compact_size(len(l)) ]
     for i in l:
-        r += i.serialize()
-    return r
+        r.append(i.serialize())
+    return ''.join(r)
 
 def deser_uint256_vector(f):
     nit = struct.unpack("<B", f.read(1))[0]
@@ -193,18 +186,17 @@ def address_to_pubkeyhash(addr):
 
 def ser_uint256_be(u):
     '''ser_uint256 to big endian'''
-    rs = ""
-    for i in xrange(8):
-        rs += struct.pack(">I", u & 0xFFFFFFFFL)
-        u >>= 32
-    return rs
+    return _words_be.pack(*_words_le.unpack(ser_uint256(u)))
 
 def deser_uint256_be(f):
-    r = 0L
-    for i in xrange(8):
-        t = struct.unpack(">I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    return uint256_from_str_be(f.read(32))
+
+def target_to_bin(target):
+    '''Serialize target to 32 bytes in big endian order. The result compares
+    with reversed hash (hash_bin[::-1]) as a string the same way as the numbers
+    do, so shares can be checked without converting the hash to long.
+    Targets above 2**256-1 (e.g. development ones) are clamped.'''
+    return binascii.unhexlify('%064x' % min(int(target), UINT256_MASK))
 
 def ser_number(n):
     # For encoding nHeight into coinbase
@@ -232,3 +224,74 @@ def convert(data):
         return type(data)(map(convert, data))
     else:
         return data
+
+
+# Tests of uint256 helpers against the original word-by-word implementations
+def _test():
+    import os
+    import time
+
+    def ref_ser_uint256(u):
+        rs = ""
+        for i in xrange(8):
+            rs += struct.pack("<I", u & 0xFFFFFFFFL)
+            u >>= 32
+        return rs
+
+    def ref_ser_uint256_be(u):
+        rs = ""
+        for i in xrange(8):
+            rs += struct.pack(">I", u & 0xFFFFFFFFL)
+            u >>= 32
+        return rs
+
+    def ref_uint256_from_str(s):
+        r = 0L
+        t = struct.unpack("<IIIIIIII", s[:32])
+        for i in xrange(8):
+            r += t[i] << (i * 32)
+        return r
+
+    def ref_uint256_from_str_be(s):
+        r = 0L
+        t = struct.unpack(">IIIIIIII", s[:32])
+        for i in xrange(8):
+            r += t[i] << (i * 32)
+        return r
+
+    values = [0, 1, 0xFFFFFFFF, UINT256_MASK, 1L << 255, UINT256_MASK + 12345, -1] + \
+             [random.getrandbits(random.choice([8, 64, 200, 256])) for _ in xrange(10000)]
+    for u in values:
+        assert ser_uint256(u) == ref_ser_uint256(u)
+        assert ser_uint256_be(u) == ref_ser_uint256_be(u)
+
+    strings = ['\0' * 32, '\xff' * 32, '\xff' * 33] + [os.urandom(32) for _ in xrange(10000)]
+    for s in strings:
+        assert uint256_from_str(s) == ref_uint256_from_str(s)
+        assert uint256_from_str_be(s) == ref_uint256_from_str_be(s)
+        assert deser_uint256(StringIO.StringIO(s)) == ref_uint256_from_str(s)
+        assert deser_uint256_be(StringIO.StringIO(s)) == ref_uint256_from_str_be(s)
+
+    for s in strings[:1000]:
+        for target in (values[7], 0x00000000ffff0000000000000000000000000000000000000000000000000000 / 3.7,
+                       UINT256_MASK + 1, 0):
+            assert (ref_uint256_from_str(s) > target) == (s[31::-1] > target_to_bin(target))
+
+    print 'OK'
+
+    s = strings[-1]
+    u = uint256_from_str(s)
+    for (name, new, ref, arg) in (('ser_uint256', ser_uint256, ref_ser_uint256, u),
+                                  ('ser_uint256_be', ser_uint256_be, ref_ser_uint256_be, u),
+                                  ('uint256_from_str', uint256_from_str, ref_uint256_from_str, s),
+                                  ('uint256_from_str_be', uint256_from_str_be, ref_uint256_from_str_be, s)):
+        timings = []
+        for func in (ref, new):
+            start = time.time()
+            for _ in xrange(100000):
+                func(arg)
+            timings.append(time.time() - start)
+        print "%-20s old %.3f sec, new %.3f sec per 100k calls" % (name, timings[0], timings[1])
+
+if __name__ == '__main__':
+    _test()
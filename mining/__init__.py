@@ -29,7 +29,39 @@ def setup(on_startup):
     from lib.coinbaser import SimpleCoinbaser
 
     import stratum.logger
+    from stratum.server import get_listener_index
     log = stratum.logger.get_logger('mining')
+
+    if getattr(settings, 'SHARE_VERIFIER_PROCESSES', 0):
+        from lib.share_verifier import ShareVerifierPool
+        share_verifier = ShareVerifierPool(settings.SHARE_VERIFIER_PROCESSES,
+                                           getattr(settings, 'SHARE_VERIFIER_BATCH_SIZE', 1000),
+                                           getattr(settings, 'SUBMITS_INDEX_LIMIT', 0),
+                                           getattr(settings, 'SUBMITS_BLOOM_BITS', 0))
+    else:
+        share_verifier = None
+
+    listener_index = get_listener_index()
+    if listener_index is not None:
+        # Listener process gets jobs from the main process
+        from lib.template_relay import RelayedTemplateRegistry
+        registry = RelayedTemplateRegistry(settings.INSTANCE_ID,
+                                           listener_index,
+                                           settings.LISTEN_PROCESSES,
+                                           MiningSubscription.on_template,
+                                           Interfaces.share_manager.on_network_block,
+                                           share_verifier)
+        Interfaces.set_template_registry(registry)
+
+        # Shares can't be checked and mining.subscribe can't
+        # be answered without a job
+        log.info("Waiting for the first job of the main process...")
+        (yield registry.on_load)
+
+        log.info("MINING SERVICE IS READY (listener %d)" % listener_index)
+        on_startup.callback(True)
+        return
+
     log.info("### INITIALIZING RSK STRATUM - CONFIG.PY DUMP ###")
     with open("conf/config.py", "r") as f:
         for line in f:
@@ -63,13 +95,25 @@ def setup(on_startup):
     coinbaser = SimpleCoinbaser(bitcoin_rpc, settings.CENTRAL_WALLET)
     (yield coinbaser.on_load)
 
+    listen_processes = getattr(settings, 'LISTEN_PROCESSES', 0)
+    if listen_processes:
+        # Socket transport connections are handled by listener processes,
+        # jobs are announced to them as well
+        from lib.template_relay import ListenerPool
+        on_template = ListenerPool(listen_processes, MiningSubscription.on_template).on_template
+    else:
+        on_template = MiningSubscription.on_template
+
     registry = TemplateRegistry(BlockTemplate,
                                 coinbaser,
                                 bitcoin_rpc,
                                 settings.INSTANCE_ID,
-                                MiningSubscription.on_template,
+                                on_template,
                                 Interfaces.share_manager.on_network_block,
-                                rootstock_rpc)
+                                rootstock_rpc,
+                                share_verifier,
+                                process_index=0,
+                                processes=listen_processes + 1)
 
     # Template registry is the main interface between Stratum service
     # and pool core logic
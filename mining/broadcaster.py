@@ -0,0 +1,166 @@
+import collections
+import operator
+from twisted.internet import reactor, defer
+
+from stratum.pubsub import Pubsub
+from mining.interfaces import Interfaces
+
+import stratum.logger
+log = stratum.logger.get_logger('broadcaster')
+
+class Broadcast(object):
+    '''State of one job broadcast in progress.'''
+
+    def __init__(self, subscribers, args, clean_jobs, start, top_count=0, delta_args=None):
+        self.subscribers = subscribers
+        self.top_count = top_count # Leading subscribers reported as top_write
+        self.args = args + (clean_jobs,)
+        self.delta_args = delta_args # mining.notify_delta params, if applicable
+        self.delta_line = None
+        self.saved_bytes = 0 # Saved by every delta notification
+        self.clean_jobs = clean_jobs
+        self.start = start
+        self.index = 0
+        self.written = 0
+        self.first_write = None
+        self.top_write = None
+        self.cache = [None, None] # Serialized notification, see Subscription._emit()
+        self.on_finish = defer.Deferred()
+
+class JobBroadcaster(object):
+    '''Writes new jobs to all subscribers of the event in slices
+    of chunk_size connections per reactor iteration, so shares and
+    new connections are served during broadcast to many clients.
+    chunk_size=0 writes to all of them at once.
+
+    A new job supersedes the broadcast in progress. Connections
+    which didn't receive the previous job yet get just the new one.
+    Jobs without clean_jobs flag are not written to connections
+    with more than max_pending bytes waiting in their write buffer
+    (until it is sent completely, see Protocol.write_buffer_full()),
+    they work on the previous job until the next broadcast.
+
+    With order_by_hashrate, connections are written in order of
+    estimated hashrate of their subscriptions (subscription.hashrate,
+    see mining.hashrate), so the biggest miners stop working
+    on the old block first.
+
+    When a job differs from the previous one only in the coinbase,
+    subscriptions with delta_notify which received the previous job
+    get mining.notify_delta instead of the full mining.notify.'''
+
+    def __init__(self, event, chunk_size=0, max_pending=0, order_by_hashrate=False, history=100):
+        self.event = event
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending
+        self.order_by_hashrate = order_by_hashrate
+        self.current = None
+        self.last_args = None # Args of the last broadcasted job
+
+        # (first, last, top 1%) write latency of recent broadcasts
+        self.latencies = collections.deque(maxlen=history)
+        self.counters = collections.Counter()
+
+    def broadcast(self, args, clean_jobs):
+        '''Broadcast job of given mining.notify args (without clean_jobs).
+        Returns Deferred firing with number of connections the job
+        was written to, once the broadcast is finished or superseded.'''
+        start = Interfaces.timestamper.time()
+
+        previous = self.current
+        if previous is not None:
+            # Connections not reached yet must drop jobs of the old block too
+            clean_jobs = clean_jobs or previous.clean_jobs
+            self.counters['superseded'] += len(previous.subscribers) - previous.index
+            self._finish(previous)
+
+        delta_args = None
+        last = self.last_args
+        if last is not None and args[1] == last[1] and args[4:] == last[4:]:
+            # Only coinb1 and coinb2 differ from the last job
+            delta_args = (args[0], last[0], args[2], args[3], clean_jobs)
+        self.last_args = args
+
+        subscribers = Pubsub.get_subscribers(self.event)
+        top_count = 0
+        if self.order_by_hashrate:
+            subscribers.sort(key=operator.attrgetter('hashrate.rank'), reverse=True)
+            top_count = (len(subscribers) + 99) // 100
+
+        b = Broadcast(subscribers, args, clean_jobs, start, top_count, delta_args)
+        self.current = b
+        self._run(b)
+        return b.on_finish
+
+    def _run(self, b):
+        if b is not self.current:
+            # Superseded by newer job
+            return
+
+        if self.chunk_size:
+            end = min(b.index + self.chunk_size, len(b.subscribers))
+        else:
+            end = len(b.subscribers)
+
+        for i in xrange(b.index, end):
+            if i == b.top_count and b.top_write is None:
+                b.top_write = Interfaces.timestamper.time()
+
+            subscription = b.subscribers[i]
+            conn = subscription.connection_ref()
+            if conn == None:
+                continue
+
+            if not b.clean_jobs and self.max_pending and conn.write_buffer_full(self.max_pending):
+                self.counters['backpressure'] += 1
+                continue
+
+            if b.delta_args is not None and subscription.delta_notify and \
+                    subscription.last_job_id == b.delta_args[1]:
+                self._write_delta(b, conn)
+            else:
+                subscription._emit(b.cache, b.args, {})
+            subscription.last_job_id = b.args[0]
+            b.written += 1
+            if b.first_write is None:
+                b.first_write = Interfaces.timestamper.time()
+
+        b.index = end
+        if end == b.top_count and b.top_write is None:
+            b.top_write = Interfaces.timestamper.time()
+        if end < len(b.subscribers):
+            reactor.callLater(0, self._run, b)
+        else:
+            self._finish(b)
+
+    def _write_delta(self, b, conn):
+        if b.delta_line is None:
+            b.delta_line = conn.serializeJsonNotification('mining.notify_delta', b.delta_args)
+            b.saved_bytes = len(conn.serializeJsonNotification(self.event, b.args)) - len(b.delta_line)
+
+        conn.writeSerialized(b.delta_line)
+        self.counters['delta_notifications'] += 1
+        self.counters['delta_saved_bytes'] += b.saved_bytes
+
+    def _finish(self, b):
+        self.current = None
+        b.subscribers = []
+
+        if b.first_write is not None:
+            self.latencies.append((b.first_write - b.start, Interfaces.timestamper.time() - b.start,
+                                   None if b.top_write is None else b.top_write - b.start))
+        self.counters['broadcasts'] += 1
+        b.on_finish.callback(b.written)
+
+    def get_stats(self):
+        '''Returns counters and percentiles of the time from
+        the job arrival to the first and the last connection written
+        and to the top 1% of hashrate written, over recent broadcasts.'''
+        stats = dict(self.counters)
+        for (i, name) in enumerate(('first_write', 'last_write', 'top_write')):
+            values = sorted(x[i] for x in self.latencies if x[i] is not None)
+            if values:
+                stats[name] = dict((p, values[min(len(values) - 1, len(values) * int(p[1:]) // 100)])
+                                   for p in ('p50', 'p90', 'p99'))
+                stats[name]['max'] = values[-1]
+        return stats
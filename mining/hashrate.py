@@ -0,0 +1,28 @@
+import math
+
+class HashrateEstimate(object):
+    '''Hashrate of one connection estimated from difficulty
+    of its accepted shares. Older shares are exponentially
+    forgotten with time constant 'window' seconds.'''
+
+    def __init__(self, window=600):
+        self.window = float(window)
+        self.work = 0.0 # Decayed sum of share difficulties
+        self.last = None
+
+        # Orders estimates the same way as get_rate() at any time,
+        # log(rate) = rank - now / window + const
+        self.rank = float('-inf')
+
+    def add(self, difficulty, now):
+        if self.last is not None:
+            self.work *= math.exp(-(now - self.last) / self.window)
+        self.work += difficulty
+        self.last = now
+        self.rank = math.log(self.work) + now / self.window
+
+    def get_rate(self, now):
+        '''Returns estimated hashes per second.'''
+        if self.last is None:
+            return 0.0
+        return self.work * math.exp(-(now - self.last) / self.window) * 2**32 / self.window
@@ -6,12 +6,40 @@ from stratum.services import GenericService, admin
 from stratum.pubsub import Pubsub
 from interfaces import Interfaces
 from subscription import MiningSubscription
+from hashrate import HashrateEstimate
 from lib.exceptions import SubmitException
 from stratum import settings
 
 import stratum.logger
 log = stratum.logger.get_logger('mining')
 
+class RejectSummary(object):
+    '''Logs number of rejected shares by reason (see
+    TemplateRegistry.count_submit()) at most once per interval,
+    a flood of bad shares doesn't cost a log line per share.'''
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.last_time = None
+        self.last_stats = {}
+        self.rejected = 0
+
+    def add(self, now):
+        self.rejected += 1
+        if self.last_time is not None and now - self.last_time < self.interval:
+            return
+
+        stats = Interfaces.template_registry.get_submit_stats()
+        reasons = dict((reason, count - self.last_stats.get(reason, 0)) for (reason, count) in stats.iteritems()
+                       if reason != 'accepted' and count != self.last_stats.get(reason, 0))
+        log.error("%d shares rejected since the last summary: %s" % (self.rejected, reasons))
+
+        self.last_time = now
+        self.last_stats = stats
+        self.rejected = 0
+
+reject_summary = RejectSummary(getattr(settings, 'REJECT_LOG_INTERVAL', 10))
+
 class MiningService(GenericService):
     '''This service provides public API for Stratum mining proxy
     or any Stratum-compatible miner software.
@@ -33,6 +61,58 @@ class MiningService(GenericService):
         Interfaces.template_registry.update_block()
         return True
 
+    @admin
+    def get_submit_stats(self):
+        '''Returns number of accepted shares and numbers of rejected
+        shares by reason (malformed, stale_job, unknown_job, ntime,
+        duplicate, above_target, unauthorized, unsubscribed, unverified) since pool start.'''
+        return Interfaces.template_registry.get_submit_stats()
+
+    @admin
+    def get_broadcast_stats(self):
+        '''Returns percentiles of time to write a new job to the first
+        and the last connection and to the top 1% of hashrate,
+        number of notifications skipped for superseded jobs
+        and slow connections, and number of delta notifications
+        with bytes they saved. Also number of template updates
+        coalesced into one broadcast.'''
+        stats = MiningSubscription.broadcaster.get_stats()
+        stats['templates'] = Interfaces.template_registry.get_coalesce_stats()
+        return stats
+
+    @admin
+    def get_template_stats(self):
+        '''Returns number of live jobs and estimated
+        memory used by their templates.'''
+        return Interfaces.template_registry.get_template_stats()
+
+    def configure(self, extensions, params=None):
+        '''Negotiate protocol extensions, in the form of BIP 310
+        mining.configure. Returns dict telling which of the requested
+        extensions are enabled on this connection. Supported ones:
+
+        delta-notify - when a new job differs from the previous one
+        only in the coinbase (e.g. RSK merged mining tag refresh),
+        the connection receives mining.notify_delta with params
+        [job_id, base_job_id, coinb1, coinb2, clean_jobs] instead
+        of the full mining.notify. The new job is base_job_id with
+        coinb1 and coinb2 replaced.'''
+
+        session = self.connection_ref().get_session()
+        result = {}
+        for extension in extensions:
+            if extension == 'delta-notify':
+                session['delta_notify'] = True
+                result[extension] = True
+
+                # Connection may be subscribed already
+                for subscription in session.get('subscriptions', {}).itervalues():
+                    if isinstance(subscription, MiningSubscription):
+                        subscription.delta_notify = True
+            else:
+                result[extension] = False
+        return result
+
     def authorize(self, worker_name, worker_password):
         '''Let authorize worker on this connection.'''
 
@@ -62,8 +142,12 @@ class MiningService(GenericService):
             session['difficulty'] = settings.RSK_STRATUM_DIFFICULTY
         else:
             session['difficulty'] = 1 # Following protocol specs, default diff is 1
+        session['hashrate'] = HashrateEstimate()
 
-        return Pubsub.subscribe(self.connection_ref(), MiningSubscription()) + (extranonce1_hex, extranonce2_size)
+        subscription = MiningSubscription()
+        subscription.hashrate = session['hashrate']
+        subscription.delta_notify = session.get('delta_notify', False)
+        return Pubsub.subscribe(self.connection_ref(), subscription) + (extranonce1_hex, extranonce2_size)
 
     '''
     def submit(self, worker_name, job_id, extranonce2, ntime, nonce):
@@ -89,6 +173,7 @@ class MiningService(GenericService):
         # Check if worker is authorized to submit shares
         if not Interfaces.worker_manager.authorize(worker_name,
                         session['authorized'].get(worker_name)):
+            Interfaces.template_registry.count_submit('unauthorized')
             raise SubmitException("Worker is not authorized")
 
         start = Interfaces.timestamper.time()
@@ -96,6 +181,7 @@ class MiningService(GenericService):
         # Check if extranonce1 is in connection session
         extranonce1_bin = session.get('extranonce1', None)
         if not extranonce1_bin:
+            Interfaces.template_registry.count_submit('unsubscribed')
             raise SubmitException("Connection is not subscribed for mining")
 
         if settings.RSK_DEV_MODE and hasattr(settings, 'RSK_STRATUM_DIFFICULTY'):
@@ -109,15 +195,38 @@ class MiningService(GenericService):
         # This checks if submitted share meet all requirements
         # and it is valid proof of work.
         try:
-            (block_header, block_hash, on_submit, on_submit_rsk) = Interfaces.template_registry.submit_share(job_id,
+            result = Interfaces.template_registry.submit_share(job_id,
                                                 worker_name, extranonce1_bin, extranonce2, ntime, nonce, difficulty)
         except SubmitException as e:
-            log.error("SUBMIT EXCEPTION: %s", e)
-            # block_header and block_hash are None when submitted data are corrupted
-            Interfaces.share_manager.on_submit_share(worker_name, None, None, difficulty,
-                                                 submit_time, False)
+            self._share_rejected(e, worker_name, difficulty, submit_time)
             raise
 
+        if isinstance(result, defer.Deferred):
+            # Share is being hashed by the share verifier
+            result.addCallbacks(self._share_accepted, self._share_failed,
+                                callbackArgs=(session, worker_name, job_id, difficulty, submit_time),
+                                errbackArgs=(worker_name, difficulty, submit_time))
+            return result
+
+        return self._share_accepted(result, session, worker_name, job_id, difficulty, submit_time)
+
+    def _share_rejected(self, e, worker_name, difficulty, submit_time):
+        log.debug("SUBMIT EXCEPTION: %s", e)
+        reject_summary.add(submit_time)
+        # block_header and block_hash are None when submitted data are corrupted
+        Interfaces.share_manager.on_submit_share(worker_name, None, None, difficulty,
+                                             submit_time, False)
+
+    def _share_failed(self, failure, worker_name, difficulty, submit_time):
+        failure.trap(SubmitException)
+        self._share_rejected(failure.value, worker_name, difficulty, submit_time)
+        return failure
+
+    def _share_accepted(self, result, session, worker_name, job_id, difficulty, submit_time):
+        (block_header, block_hash, on_submit, on_submit_rsk) = result
+
+        # Used for ordering of job broadcasts
+        session['hashrate'].add(difficulty, submit_time)
 
         Interfaces.share_manager.on_submit_share(worker_name, block_header, block_hash, difficulty,
                                                  submit_time, True)
@@ -145,6 +254,19 @@ class MiningService(GenericService):
     update_block.help_text = "Notify Stratum server about new block on the network."
     update_block.params = [('password', 'string', 'Administrator password'),]
 
+    get_submit_stats.help_text = "Returns counters of accepted and rejected shares by reject reason."
+    get_submit_stats.params = [('password', 'string', 'Administrator password'),]
+
+    get_broadcast_stats.help_text = "Returns latency of recent job broadcasts."
+    get_broadcast_stats.params = [('password', 'string', 'Administrator password'),]
+
+    get_template_stats.help_text = "Returns number of live jobs and memory used by their templates."
+    get_template_stats.params = [('password', 'string', 'Administrator password'),]
+
+    configure.help_text = "Enable protocol extensions (delta-notify) on this connection."
+    configure.params = [('extensions', 'list', 'Names of requested extensions.'),
+                        ('params', 'object', 'Parameters of the extensions (optional).'),]
+
     authorize.help_text = "Authorize worker for submitting shares on this connection."
     authorize.params = [('worker_name', 'string', 'Name of the worker, usually in the form of user_login.worker_id.'),
                         ('worker_password', 'string', 'Worker password'),]
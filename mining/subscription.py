@@ -1,4 +1,6 @@
 from stratum.pubsub import Pubsub, Subscription
+from mining.broadcaster import JobBroadcaster
+from mining.hashrate import HashrateEstimate
 from mining.interfaces import Interfaces
 from lib import util
 from mining.interfaces import Interfaces
@@ -13,6 +15,16 @@ class MiningSubscription(Subscription):
 
     event = 'mining.notify'
 
+    # Estimate of the connection, replaced by MiningService.subscribe().
+    # The default one is never updated, it ranks below everything.
+    hashrate = HashrateEstimate()
+
+    # Connection accepts mining.notify_delta, see MiningService.configure()
+    delta_notify = False
+
+    # Last job written to the connection, base of delta notifications
+    last_job_id = None
+
     @classmethod
     def on_template(cls, is_new_block):
         '''This is called when TemplateRegistry registers
@@ -23,10 +35,12 @@ class MiningSubscription(Subscription):
         #                Interfaces.template_registry.get_last_broadcast_args()
         bc_args = Interfaces.template_registry.get_last_broadcast_args()
         (job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, _, rsk_flag) = bc_args
-        # Push new job to subscribed clients
-        cls.emit(job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, clean_jobs)
+        # Push new job to subscribed clients, it may take few reactor iterations
+        d = cls.broadcaster.broadcast((job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime), clean_jobs)
+        d.addCallback(cls._on_broadcasted, start, bc_args, rsk_flag)
 
-        cnt = Pubsub.get_subscription_count(cls.event)
+    @classmethod
+    def _on_broadcasted(cls, cnt, start, bc_args, rsk_flag):
         log.info("BROADCASTED to %d connections in %.03f sec" % (cnt, (Interfaces.timestamper.time() - start)))
         if rsk_flag:
             log.info(json.dumps({"rsk" : "[RSKLOG]", "tag" : "[RSK_BLOCK_RECEIVED_END]", "uuid" : util.id_generator(), "start" : start, "elapsed" : Interfaces.timestamper.time() - start, "data" : bc_args, "clients" : cnt}))
@@ -53,6 +67,7 @@ class MiningSubscription(Subscription):
         # Force client to remove previous jobs if any (eg. from previous connection)
         clean_jobs = True
         self.emit_single(job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, clean_jobs)
+        self.last_job_id = job_id
 
         log.info(json.dumps({"uuid" : util.id_generator(), "rsk" : "[RSKLOG]", "tag" : "[WORK_SENT_OLD]", "start" : start, "elapsed" : Interfaces.timestamper.time() - start, "data" : bc_args}))
 
@@ -63,3 +78,8 @@ class MiningSubscription(Subscription):
         on_finish callback solve the issue that job is broadcasted *during*
         the subscription request and client receive messages in wrong order.'''
         self.connection_ref().on_finish.addCallback(self._finish_after_subscribe)
+
+MiningSubscription.broadcaster = JobBroadcaster(MiningSubscription.event,
+                                                getattr(settings, 'BROADCAST_CHUNK_SIZE', 0),
+                                                getattr(settings, 'BROADCAST_MAX_PENDING', 0),
+                                                getattr(settings, 'BROADCAST_BY_HASHRATE', False))
@@ -3,18 +3,29 @@ from twisted.internet import reactor
 from services import GenericService
 
 class ConnectionRegistry(object):
-    __connections = weakref.WeakKeyDictionary()
-    
+    '''Open connections by integer connection_id. Connections
+    are added by connectionMade() and removed by connectionLost().'''
+    __connections = {}
+    __last_id = 0
+
     @classmethod
     def add_connection(cls, conn):
-        cls.__connections[conn] = True
+        cls.__last_id += 1
+        conn.connection_id = cls.__last_id
+        cls.__connections[conn.connection_id] = conn
+        return conn.connection_id
 
     @classmethod
     def remove_connection(cls, conn):
         try:
-            del cls.__connections[conn]
-        except:
-            print "Warning: Cannot remove connection from ConnectionRegistry"  
+            del cls.__connections[conn.connection_id]
+        except (KeyError, AttributeError):
+            print "Warning: Cannot remove connection from ConnectionRegistry"
+
+    @classmethod
+    def get_connection(cls, connection_id):
+        return cls.__connections.get(connection_id)
+
         
     @classmethod
     def get_session(cls, conn):
@@ -31,11 +42,10 @@ class ConnectionRegistry(object):
     
     @classmethod
     def iterate(cls):
-        return cls.__connections.iterkeyrefs()
+        return cls.__connections.values()
         
 def dump_connections():
-    for x in ConnectionRegistry.iterate():
-        c = x()
+    for c in ConnectionRegistry.iterate():
         c.transport.write('cus')
         print '!!!', c
     reactor.callLater(5, dump_connections)
@@ -0,0 +1,76 @@
+'''JSON codec of the wire protocol. Decoder and encoder are selected
+by settings.JSON_DECODER and settings.JSON_ENCODER, one of:
+
+json       - standard library, with its C speedups
+simplejson - simplejson, with its C speedups when compiled. Its decoder
+             returns ASCII strings as str instead of unicode.
+ujson      - ujson, output is without spaces
+
+Codec which isn't installed is replaced by the standard library.
+See tools/bench_json_codec.py for comparison of them.'''
+
+import json
+
+import settings
+import logger
+log = logger.get_logger('json_codec')
+
+def _load_module(name):
+    if name == 'json':
+        return json
+
+    try:
+        if name == 'simplejson':
+            import simplejson
+            return simplejson
+        if name == 'ujson':
+            import ujson
+            return ujson
+    except ImportError:
+        log.warning("JSON codec '%s' not installed, using json instead" % name)
+        return json
+
+    raise ValueError("Unknown JSON codec '%s'" % name)
+
+def get_decoder(name):
+    '''Returns function decoding JSON string.'''
+    module = _load_module(name)
+    if module.__name__ in ('json', 'simplejson'):
+        # Skips keyword arguments handling of loads()
+        return module.JSONDecoder().decode
+    return module.loads
+
+def get_encoder(name):
+    '''Returns function encoding object to JSON string.'''
+    module = _load_module(name)
+    if module.__name__ in ('json', 'simplejson'):
+        return module.JSONEncoder().encode
+    return module.dumps
+
+class JsonCodec(object):
+    '''Decodes received lines and builds lines of messages
+    written by stratum.protocol.Protocol.'''
+
+    def __init__(self, decoder='json', encoder='json'):
+        self.decoder = decoder
+        self.encoder = encoder
+        self.loads = get_decoder(decoder)
+        self.dumps = get_encoder(encoder)
+
+        # Answer of accepted mining.submit, most of messages written.
+        # Made by the encoder itself, so it's the same as response() output.
+        self._true_response = "%s\n" % self.dumps({'id': 1234567, 'result': True, 'error': None})
+        self._true_response = self._true_response.replace('1234567', '%d')
+
+    def request(self, message_id, method, params):
+        return "%s\n" % self.dumps({'id': message_id, 'method': method, 'params': params})
+
+    def response(self, message_id, result):
+        if result is True and type(message_id) is int:
+            return self._true_response % message_id
+        return "%s\n" % self.dumps({'id': message_id, 'result': result, 'error': None})
+
+    def error(self, message_id, code, message, traceback):
+        return "%s\n" % self.dumps({'id': message_id, 'result': None, 'error': (code, message, traceback)})
+
+codec = JsonCodec(getattr(settings, 'JSON_DECODER', 'json'), getattr(settings, 'JSON_ENCODER', 'json'))
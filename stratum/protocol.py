@@ -1,17 +1,20 @@
-import json
 #import jsonical
 import time
 import socket
 
 from twisted.protocols.basic import LineOnlyReceiver
 from twisted.internet import defer, reactor, error
+from twisted.internet.interfaces import IPushProducer
 from twisted.python.failure import Failure
+from zope.interface import implements
 import types
 import stats
 import signature
 import custom_exceptions
 import connection_registry
+import pubsub
 import settings
+from json_codec import codec
 import logger
 log = logger.get_logger('protocol')
 
@@ -34,6 +37,63 @@ class RequestCounter(object):
         if not self.on_finish.called:
             self.on_finish.callback(True)
 
+class ConnectionRequestCounter(object):
+    '''Counts requests of one connection waiting for the response.
+    Used by transports reading a stream (socket, websocket) instead
+    of RequestCounter with new Deferred for every read. It lives
+    as long as the connection and serves as its on_finish, callbacks
+    added by addCallback() are called once all requests received
+    so far are processed, immediately if there are none.'''
+
+    def __init__(self):
+        self.counter = 0
+        self.callbacks = None
+
+    def decrease(self):
+        self.counter -= 1
+        if self.counter <= 0:
+            self.finish()
+
+    def finish(self):
+        self.counter = 0
+        callbacks = self.callbacks
+        if callbacks:
+            self.callbacks = None
+            for (func, args, kwargs) in callbacks:
+                func(True, *args, **kwargs)
+
+    def addCallback(self, func, *args, **kwargs):
+        if self.counter > 0:
+            if self.callbacks is None:
+                self.callbacks = []
+            self.callbacks.append((func, args, kwargs))
+        else:
+            func(True, *args, **kwargs)
+        return self
+
+
+class WriteBufferMonitor(object):
+    '''Streaming producer registered on the transport just to learn
+    whether its write buffer is full. The transport pauses it once more
+    than transport.bufferSize bytes wait to be sent and resumes it
+    when all of them are sent.'''
+    implements(IPushProducer)
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        if self.transport.disconnecting:
+            # Registered producer keeps the connection open after loseConnection()
+            self.transport.unregisterProducer()
+
+    def stopProducing(self):
+        self.paused = False
 
 def n_writeSomeData(self, data):
     print time.time()
@@ -74,14 +134,22 @@ class Protocol(LineOnlyReceiver):
 
         # Read settings.TCP_PROXY_PROTOCOL documentation
         self.expect_tcp_proxy_protocol_header = self.factory.__dict__.get('tcp_proxy_protocol_enable', False)
+        self.write_monitor = WriteBufferMonitor(self.transport) # See write_buffer_full()
+        try:
+            self.transport.registerProducer(self.write_monitor, True)
+        except (AttributeError, RuntimeError):
+            # Transport doesn't take producers or has one already
+            self.write_monitor = None
         self.proxied_ip = None # IP obtained from TCP proxy protocol
 
         self.request_id = 0
         self.lookup_table = {}
         self.event_handler = self.factory.event_handler()
         self.on_disconnect = defer.Deferred()
-        self.on_finish = None # Will point to defer which is called
-                        # once all client requests are processed
+        self.on_finish = self.request_counter = ConnectionRequestCounter() # Called once all client
+                        # requests are processed, replaced by RequestCounter.on_finish for HTTP requests
+        self._buffer_chunks = [] # Unterminated line received so far
+        self._buffer_length = 0
 
         # Initiate connection session
         self.session = {}
@@ -99,45 +167,68 @@ class Protocol(LineOnlyReceiver):
             # Transport is disconnected
             pass
 
+    def write_buffer_full(self, limit):
+        '''True once more than limit bytes written to the transport
+        wait to be sent, until all of them are sent. Always False
+        for transports which don't take producers.'''
+        if self.write_monitor is None:
+            return False
+        self.transport.bufferSize = limit
+        return self.write_monitor.paused
+
     def connectionLost(self, reason):
         if self.on_disconnect != None and not self.on_disconnect.called:
             self.on_disconnect.callback(self)
             self.on_disconnect = None
 
         stats.PeerStats.client_disconnected(self._get_ip())
+        pubsub.Pubsub.unregister_connection(self)
         connection_registry.ConnectionRegistry.remove_connection(self)
         self.transport = None # Fixes memory leak (cyclic reference)
 
     def writeJsonRequest(self, method, params, is_notification=False):
         request_id = None if is_notification else self._get_id()
-        serialized = json.dumps({'id': request_id, 'method': method, 'params': params})
+        serialized = codec.request(request_id, method, params)
 
         if self.factory.debug:
-            log.debug("< %s" % serialized)
+            log.debug("< %s" % serialized.rstrip())
 
-        self.transport_write("%s\n" % serialized)
+        self.transport_write(serialized)
         return request_id
 
+    @staticmethod
+    def serializeJsonNotification(method, params):
+        '''Returns line of notification as written by writeJsonRequest(),
+        it doesn't depend on the connection, so it can be written
+        to many connections by writeSerialized().'''
+        return codec.request(None, method, params)
+
+    def writeSerialized(self, line):
+        if self.factory.debug:
+            log.debug("< %s" % line.rstrip())
+
+        self.transport_write(line)
+
     def writeJsonResponse(self, data, message_id, use_signature=False, sign_method='', sign_params=[]):
         if use_signature:
             serialized = signature.jsonrpc_dumps_sign(self.factory.signing_key, self.factory.signing_id, False,\
-                message_id, sign_method, sign_params, data, None)
+                message_id, sign_method, sign_params, data, None) + "\n"
         else:
-            serialized = json.dumps({'id': message_id, 'result': data, 'error': None})
+            serialized = codec.response(message_id, data)
 
         if self.factory.debug:
-            log.debug("< %s" % serialized)
+            log.debug("< %s" % serialized.rstrip())
 
-        self.transport_write("%s\n" % serialized)
+        self.transport_write(serialized)
 
     def writeJsonError(self, code, message, traceback, message_id, use_signature=False, sign_method='', sign_params=[]):
         if use_signature:
             serialized = signature.jsonrpc_dumps_sign(self.factory.signing_key, self.factory.signing_id, False,\
-                message_id, sign_method, sign_params, None, (code, message, traceback))
+                message_id, sign_method, sign_params, None, (code, message, traceback)) + "\n"
         else:
-            serialized = json.dumps({'id': message_id, 'result': None, 'error': (code, message, traceback)})
+            serialized = codec.error(message_id, code, message, traceback)
 
-        self.transport_write("%s\n" % serialized)
+        self.transport_write(serialized)
 
     def writeGeneralError(self, message, code=-1):
         log.error(message)
@@ -177,12 +268,13 @@ class Protocol(LineOnlyReceiver):
         '''Original code from Twisted, hacked for request_counter proxying.
         request_counter is hack for HTTP transport, didn't found cleaner solution how
         to indicate end of request processing in asynchronous manner.
+        Reads of other transports go to streamReceived().
 
         TODO: This would deserve some unit test to be sure that future twisted versions
         will work nicely with this.'''
 
         if request_counter == None:
-            request_counter = RequestCounter()
+            return self.streamReceived(data)
 
         lines  = (self._buffer+data).split(self.delimiter)
         self._buffer = lines.pop(-1)
@@ -209,6 +301,58 @@ class Protocol(LineOnlyReceiver):
             request_counter.finish()
             return self.lineLengthExceeded(self._buffer)
 
+    def streamReceived(self, data):
+        '''Same as dataReceived(), but counts requests by request_counter
+        of the connection. Unterminated line is kept as list of received
+        chunks and only the new data are searched for the delimiter,
+        so a line received in many small reads isn't copied on every read.'''
+        request_counter = self.request_counter
+        delimiter = self.delimiter
+        chunks = self._buffer_chunks
+
+        end = data.find(delimiter)
+        if end < 0:
+            chunks.append(data)
+            self._buffer_length += len(data)
+            if self._buffer_length > self.MAX_LENGTH:
+                return self.lineLengthExceeded(''.join(chunks))
+            return
+
+        if chunks:
+            line = ''.join(chunks) + data[:end]
+            del chunks[:]
+            self._buffer_length = 0
+        else:
+            line = data[:end]
+
+        while True:
+            if self.transport.disconnecting:
+                request_counter.finish()
+                return
+            if len(line) > self.MAX_LENGTH:
+                request_counter.finish()
+                return self.lineLengthExceeded(line)
+
+            request_counter.counter += 1
+            try:
+                self.lineReceived(line, request_counter)
+            except Exception as exc:
+                request_counter.finish()
+                log.warning("Failed message: %s from %s" % (str(exc), self._get_ip()))
+                return error.ConnectionLost('Processing of message failed')
+
+            start = end + len(delimiter)
+            end = data.find(delimiter, start)
+            if end < 0:
+                break
+            line = data[start:end]
+
+        if start < len(data):
+            chunks.append(data[start:])
+            self._buffer_length = len(data) - start
+            if self._buffer_length > self.MAX_LENGTH:
+                return self.lineLengthExceeded(chunks[0])
+
     def lineReceived(self, line, request_counter):
         if self.expect_tcp_proxy_protocol_header:
             # This flag may be set only for TCP transport AND when TCP_PROXY_PROTOCOL
@@ -226,7 +370,7 @@ class Protocol(LineOnlyReceiver):
                 return
 
         try:
-            message = json.loads(line)
+            message = codec.loads(line)
         except:
             #self.writeGeneralError("Cannot decode message '%s'" % line)
             request_counter.finish()
@@ -256,10 +400,16 @@ class Protocol(LineOnlyReceiver):
                 if msg_id == None:
                     # It's notification, don't expect the response
                     request_counter.decrease()
-                else:
+                elif isinstance(result, defer.Deferred):
                     # It's a RPC call
                     result.addCallback(self.process_response, msg_id, msg_method, msg_params, request_counter)
                     result.addErrback(self.process_failure, msg_id, msg_method, msg_params, request_counter)
+                else:
+                    # It's a RPC call answered synchronously, with ResultObject
+                    try:
+                        self.process_response(result, msg_id, msg_method, msg_params, request_counter)
+                    except:
+                        self.process_failure(Failure(), msg_id, msg_method, msg_params, request_counter)
 
         elif msg_id:
             # It's a RPC response
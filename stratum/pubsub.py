@@ -1,4 +1,3 @@
-import weakref
 from connection_registry import ConnectionRegistry
 import custom_exceptions
 import hashlib
@@ -32,15 +31,24 @@ class Subscription(object):
                 self.event = event
         
         self.params = params # Internal parameters for subscription object
-        self.connection_ref = None
+        self.connection_id = None # See ConnectionRegistry
+        self._key = None
+        self._index = None # Position in Pubsub list of the event subscribers
             
+    def connection_ref(self):
+        '''Connection of the subscriber, None when it is closed'''
+        return ConnectionRegistry.get_connection(self.connection_id)
+
     def process(self, *args, **kwargs):
         return args
             
     def get_key(self):
         '''This is an identifier for current subscription. It is sent to the client,
-        so result should not contain any sensitive information.'''
-        return hashlib.md5(str((self.event, self.params))).hexdigest()
+        so result should not contain any sensitive information.
+        It is computed once, params must not change after subscribing.'''
+        if self._key is None:
+            self._key = hashlib.md5(str((self.event, self.params))).hexdigest()
+        return self._key
     
     def get_session(self):
         '''Connection session may be useful in filter or process functions'''
@@ -55,6 +63,12 @@ class Subscription(object):
         
     def emit_single(self, *args, **kwargs):
         '''Perform emit of this event just for current subscription.'''
+        self._emit(None, args, kwargs)
+
+    def _emit(self, cache, args, kwargs):
+        '''cache is [payload, line] list shared by all subscriptions
+        of one Pubsub.emit() call. Subscriptions whose process() returns
+        the same payload write the same line, serialized just once.'''
         conn = self.connection_ref()
         if conn == None:
             # Connection is closed
@@ -63,7 +77,14 @@ class Subscription(object):
         payload = self.process(*args, **kwargs)
         if payload != None:
             if isinstance(payload, (tuple, list)):
-                conn.writeJsonRequest(self.event, payload, is_notification=True)
+                if cache is not None and cache[1] is not None and cache[0] == payload:
+                    line = cache[1]
+                else:
+                    line = conn.serializeJsonNotification(self.event, payload)
+                    if cache is not None:
+                        cache[:] = [payload, line]
+
+                conn.writeSerialized(line)
                 self.after_emit(*args, **kwargs)
             else:
                 raise Exception("Return object from process() method must be list or None")
@@ -82,6 +103,9 @@ class Subscription(object):
         return not self.__eq__(other)
     
 class Pubsub(object):
+    '''Subscriptions are kept in a plain list per event. Every subscription
+    knows its position there, so it is removed in constant time when
+    it is unsubscribed or its connection is lost (see unregister_connection()).'''
     __subscriptions = {}
     
     @classmethod
@@ -94,7 +118,7 @@ class Pubsub(object):
         if session == None:
             raise custom_exceptions.PubsubException("No session found")
         
-        subscription.connection_ref = weakref.ref(connection)
+        subscription.connection_id = connection.connection_id
         session.setdefault('subscriptions', {})
         
         if key in session['subscriptions']:
@@ -102,8 +126,9 @@ class Pubsub(object):
         
         session['subscriptions'][key] = subscription
                     
-        cls.__subscriptions.setdefault(subscription.event, weakref.WeakKeyDictionary())
-        cls.__subscriptions[subscription.event][subscription] = None
+        subscribers = cls.__subscriptions.setdefault(subscription.event, [])
+        subscription._index = len(subscribers)
+        subscribers.append(subscription)
         
         if hasattr(subscription, 'after_subscribe'):
             if connection.on_finish != None:
@@ -131,18 +156,42 @@ class Pubsub(object):
             key = subscription.get_key()
 
         try:
-            # Subscription don't need to be removed from cls.__subscriptions,
-            # because it uses weak reference there.
-            del session['subscriptions'][key]
+            subscription = session['subscriptions'].pop(key)
         except KeyError:
             print "Warning: Cannot remove subscription from connection session"
             return False
-            
+
+        cls._remove(subscription)
         return True
-        
+
+    @classmethod
+    def unregister_connection(cls, connection):
+        '''Remove all subscriptions of the lost connection.'''
+        session = connection.get_session()
+        if session == None:
+            return
+
+        for subscription in session.get('subscriptions', {}).itervalues():
+            cls._remove(subscription)
+
+    @classmethod
+    def _remove(cls, subscription):
+        index = subscription._index
+        if index is None:
+            # Not subscribed
+            return
+
+        # Move the last subscriber to the freed position
+        subscribers = cls.__subscriptions[subscription.event]
+        last = subscribers.pop()
+        if last is not subscription:
+            subscribers[index] = last
+            last._index = index
+        subscription._index = None
+
     @classmethod
     def get_subscription_count(cls, event):
-        return len(cls.__subscriptions.get(event, {}))
+        return len(cls.__subscriptions.get(event, ()))
 
     @classmethod
     def get_subscription(cls, connection, event, key=None):
@@ -161,17 +210,20 @@ class Pubsub(object):
         else:
             raise Exception("Searching subscriptions by key is not implemented yet")
               
+    @classmethod
+    def get_subscribers(cls, event):
+        '''Returns new list of current subscriptions of the event.'''
+        return list(cls.__subscriptions.get(event, ()))
+
     @classmethod
     def iterate_subscribers(cls, event):
-        for subscription in cls.__subscriptions.get(event, weakref.WeakKeyDictionary()).iterkeyrefs():
-            subscription = subscription()
-            if subscription == None:
-                # Subscriber is no more connected
-                continue
-            
-            yield subscription
+        # Iterate over a copy, emit may lead to unsubscribing
+        return iter(cls.get_subscribers(event))
             
     @classmethod
     def emit(cls, event, *args, **kwargs):
-        for subscription in cls.iterate_subscribers(event):                        
-            subscription.emit_single(*args, **kwargs)
\ No newline at end of file
+        # Notification is serialized once and written to all
+        # subscribers, unless their process() gives another payload
+        cache = [None, None]
+        for subscription in cls.iterate_subscribers(event):
+            subscription._emit(cache, args, kwargs)
\ No newline at end of file
@@ -1,3 +1,17 @@
+import os
+
+# Set to the process index in listener processes spawned
+# by lib.template_relay.ListenerPool, see settings.LISTEN_PROCESSES
+LISTENER_ENV = 'STRATUM_LISTENER'
+
+def get_listener_index():
+    '''Returns index of this listener process (1 and up),
+    None in the main process.'''
+    index = os.environ.get(LISTENER_ENV)
+    if index is None:
+        return None
+    return int(index)
+
 def setup(setup_event=None):
     try:
         from twisted.internet import epollreactor
@@ -66,9 +80,18 @@ def setup_finalize(event, application):
     # Set up thread pool size for service threads
     reactor.suggestThreadPoolSize(settings.THREAD_POOL_SIZE)
 
-    if settings.LISTEN_SOCKET_TRANSPORT:
+    listener_index = get_listener_index()
+    if listener_index is not None:
+        server_class = socket_transport.ReusePortTCPServer
+    elif getattr(settings, 'LISTEN_PROCESSES', 0):
+        # Listener processes accept socket connections, not this one
+        server_class = None
+    else:
+        server_class = internet.TCPServer
+
+    if settings.LISTEN_SOCKET_TRANSPORT and server_class is not None:
         # Attach Socket Transport service to application
-        socket = internet.TCPServer(settings.LISTEN_SOCKET_TRANSPORT,
+        socket = server_class(settings.LISTEN_SOCKET_TRANSPORT,
                                 socket_transport.SocketTransportFactory(debug=settings.DEBUG,
                                                                         signing_key=signing_key,
                                                                         signing_id=settings.SIGNING_ID,
@@ -76,6 +99,10 @@ def setup_finalize(event, application):
                                                                         tcp_proxy_protocol_enable=settings.TCP_PROXY_PROTOCOL))
         socket.setServiceParent(application)
 
+    if listener_index is not None:
+        # Other transports stay in the main process
+        return event
+
     # Build the HTTP interface
     httpsite = Site(http_transport.Root(debug=settings.DEBUG, signing_key=signing_key, signing_id=settings.SIGNING_ID,
                                         event_handler=ServiceEventHandler))
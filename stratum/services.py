@@ -9,8 +9,25 @@ import custom_exceptions
 VENDOR_RE = re.compile(r'\[(.*)\]')
 
 class ServiceEventHandler(object): # reimplements event_handler.GenericEventHandler
+    '''Created for every connection. Service instances and their methods
+    are looked up by the first call of the method by the connection.'''
+
+    def __init__(self):
+        self.services = {} # Mapping service class -> instance for this connection
+        self.handlers = {} # Mapping full method name -> bound method
+
     def _handle_event(self, msg_method, msg_params, connection_ref):
-        return ServiceFactory.call(msg_method, msg_params, connection_ref=connection_ref)
+        func = self.handlers.get(msg_method)
+        if func == None:
+            func = ServiceFactory.get_handler(msg_method, connection_ref, self.services)
+            if func == None:
+                # Not in the dispatch table, raises proper exception or finds it the slow way
+                return ServiceFactory.call(msg_method, msg_params, connection_ref=connection_ref)
+            self.handlers[msg_method] = func
+
+        # Result of synchronous method isn't wrapped to Deferred,
+        # Protocol.lineReceived() writes the response at once
+        return wrap_result_object(func(*msg_params))
         
 class ResultObject(object):
     def __init__(self, result=None, sign=False, sign_algo=None, sign_id=None):
@@ -34,6 +51,7 @@ def wrap_result_object(obj):
 
 class ServiceFactory(object):
     registry = {} # Mapping service_type -> vendor -> cls
+    methods = {} # Mapping full method name -> (cls, method name), see register_methods()
     
     @classmethod
     def _split_method(cls, method):
@@ -80,6 +98,40 @@ class ServiceFactory(object):
         # Returns Defer which will lead to ResultObject sometimes
         return defer.maybeDeferred(_run, func, *params)
         
+    @classmethod
+    def get_handler(cls, method, connection_ref, services):
+        '''Returns method of the service instance in services, dict of service
+        instances of the connection, or None if the method isn't
+        in the dispatch table. Missing instance is created.'''
+        try:
+            (_cls, func_name) = cls.methods[method]
+        except KeyError:
+            return None
+
+        try:
+            _inst = services[_cls]
+        except KeyError:
+            _inst = services[_cls] = _cls()
+            _inst.connection_ref = weakref.ref(connection_ref)
+        return getattr(_inst, func_name)
+
+    @classmethod
+    def register_methods(cls, service_type):
+        '''Fills the dispatch table with public methods of all vendors of the service
+        type, as "service_type[vendor].method" and "service_type.method"
+        of the class returned by lookup().'''
+        for method in [ m for m in cls.methods if cls._split_method(m)[0] == service_type ]:
+            del cls.methods[method]
+
+        def _register(_cls, prefix):
+            for name in dir(_cls):
+                if not name.startswith('_') and callable(getattr(_cls, name)):
+                    cls.methods["%s.%s" % (prefix, name)] = (_cls, name)
+
+        for (vendor, _cls) in cls.registry[service_type].items():
+            _register(_cls, "%s[%s]" % (service_type, vendor))
+        _register(cls.lookup(service_type), service_type)
+
     @classmethod
     def lookup(cls, service_type, vendor=None):
         # Lookup for service type provided by specific vendor
@@ -142,6 +194,7 @@ class ServiceFactory(object):
 
         ServiceFactory.registry.setdefault(service_type, {})
         ServiceFactory.registry[service_type][service_vendor] = _cls
+        ServiceFactory.register_methods(service_type)
         
         log.msg("Registered %s for service '%s', vendor '%s' (default: %s)" % (_cls, service_type, service_vendor, is_default))
                
@@ -1,6 +1,8 @@
+import socket
 from twisted.internet.protocol import ServerFactory
 from twisted.internet.protocol import ReconnectingClientFactory
-from twisted.internet import reactor, defer, endpoints
+from twisted.internet import reactor, defer, endpoints, tcp
+from twisted.application import internet
 
 import socksclient
 import custom_exceptions
@@ -10,6 +12,9 @@ from event_handler import GenericEventHandler
 import logger
 log = logger.get_logger('socket_transport')
 
+# Python 2.7 doesn't define it, this is the Linux value
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
 def sockswrapper(proxy, dest):
     endpoint = endpoints.TCP4ClientEndpoint(reactor, dest[0], dest[1])
     return socksclient.SOCKSWrapper(reactor, proxy[0], proxy[1], endpoint)
@@ -26,6 +31,23 @@ class SocketTransportFactory(ServerFactory):
         # Read settings.TCP_PROXY_PROTOCOL documentation
         self.tcp_proxy_protocol_enable = tcp_proxy_protocol_enable
         
+class ReusePort(tcp.Port):
+    '''Listening port with SO_REUSEPORT. Processes listening
+    on the same port get incoming connections spread by the kernel.'''
+
+    def createInternetSocket(self):
+        s = tcp.Port.createInternetSocket(self)
+        s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        return s
+
+class ReusePortTCPServer(internet.TCPServer):
+    '''TCPServer service listening by ReusePort.'''
+
+    def _getPort(self):
+        port = ReusePort(reactor=reactor, *self.args, **self.kwargs)
+        port.startListening()
+        return port
+
 class SocketTransportClientFactory(ReconnectingClientFactory):
     def __init__(self, host, port, allow_trusted=True, allow_untrusted=False,
                  debug=False, signing_key=None, signing_id=None,
@@ -0,0 +1,165 @@
+'''Time of broadcasting one mining.notify to many subscribers.
+
+Subscribes --connections protocol instances with in-memory transports
+and compares serializing the notification for every connection
+with Pubsub.emit(), which serializes it once. Then measures
+JobBroadcaster writing in chunks of --chunk-size connections,
+the time until the top 1% of hashrate is written
+with and without ordering by hashrate, and bytes written for
+RSK refresh with and without delta notifications.
+Run from the repository root: python tools/bench_broadcast.py'''
+
+import os
+import sys
+import time
+import random
+import argparse
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[0:0] = [os.path.join(root, 'conf'), root]
+
+from stratum.protocol import Protocol
+from stratum.pubsub import Pubsub
+from stratum.connection_registry import ConnectionRegistry
+from mining.interfaces import Interfaces, TimestamperInterface
+from mining.broadcaster import JobBroadcaster
+from mining.hashrate import HashrateEstimate
+from mining.subscription import MiningSubscription
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-c', '--connections', type=int, default=20000, help='Number of subscribed connections')
+parser.add_argument('-s', '--chunk-size', type=int, default=1000, help='Connections per reactor iteration for JobBroadcaster')
+parser.add_argument('-b', '--branch', type=int, default=12, help='Length of merkle branch in the notification')
+args = parser.parse_args()
+
+class Transport(object):
+    disconnecting = False
+
+    def __init__(self):
+        self.written = 0
+        self.last_write = None
+
+    def write(self, data):
+        self.written += len(data)
+        self.last_write = time.time()
+
+class Factory(object):
+    debug = False
+
+class NotifySubscription(MiningSubscription):
+    def after_subscribe(self, *args):
+        # No template registry here
+        pass
+
+def make_connection():
+    conn = Protocol()
+    conn.factory = Factory()
+    conn.transport = Transport()
+    conn.session = {}
+    conn.on_finish = None
+    ConnectionRegistry.add_connection(conn)
+    return conn
+
+def notify_args():
+    return ('1a2b', 'ab' * 32, '01' * 60, '02' * 60, ['cd' * 32] * args.branch,
+            '20000000', '1d00ffff', '5b000000', True)
+
+def per_connection(connections, params):
+    for subscription in Pubsub.iterate_subscribers(NotifySubscription.event):
+        subscription.connection_ref().writeJsonRequest(subscription.event, params, is_notification=True)
+
+def shared(connections, params):
+    NotifySubscription.emit(*params)
+
+def run(name, func, connections):
+    params = notify_args()
+    start = time.time()
+    func(connections, params)
+    elapsed = time.time() - start
+    written = sum(c.transport.written for c in connections)
+    print "%-15s BROADCASTED to %d connections in %.03f sec, %d bytes written" % (name, len(connections), elapsed, written)
+    for c in connections:
+        c.transport.written = 0
+
+connections = [ make_connection() for _ in xrange(args.connections) ]
+for conn in connections:
+    Pubsub.subscribe(conn, NotifySubscription())
+
+run('per connection', per_connection, connections)
+run('shared', shared, connections)
+
+def run_chunked(connections):
+    from twisted.internet import reactor, defer
+
+    @defer.inlineCallbacks
+    def superseded():
+        # Every broadcast but the last one is superseded after two chunks
+        broadcaster = JobBroadcaster(NotifySubscription.event, args.chunk_size)
+        for _ in xrange(10):
+            broadcaster.broadcast(notify_args()[:-1], False)
+            for _ in xrange(2):
+                d = defer.Deferred()
+                reactor.callLater(0, d.callback, None)
+                yield d
+        yield broadcaster.broadcast(notify_args()[:-1], False)
+
+        stats = broadcaster.get_stats()
+        print "chunked         %d broadcasts, %d superseded notifications" % (stats['broadcasts'], stats.get('superseded', 0))
+        for name in ('first_write', 'last_write'):
+            print "    %-11s %s" % (name, ', '.join("%s %.03f sec" % (p, stats[name][p]) for p in ('p50', 'p90', 'p99', 'max')))
+
+    @defer.inlineCallbacks
+    def ordered(order_by_hashrate):
+        now = time.time()
+        top = sorted(connections, key=lambda c: c.session['hashrate'].get_rate(now), reverse=True)
+        top = top[:(len(top) + 99) // 100]
+
+        broadcaster = JobBroadcaster(NotifySubscription.event, args.chunk_size, 0, order_by_hashrate)
+        start = time.time()
+        yield broadcaster.broadcast(notify_args()[:-1], True)
+        print "%-15s top 1%% of hashrate written in %.03f sec, all in %.03f sec" % (
+            'by hashrate' if order_by_hashrate else 'unordered',
+            max(c.transport.last_write for c in top) - start, time.time() - start)
+
+    @defer.inlineCallbacks
+    def delta(delta_notify):
+        for c in connections:
+            c.session['subscriptions'].values()[0].delta_notify = delta_notify
+
+        broadcaster = JobBroadcaster(NotifySubscription.event, args.chunk_size)
+        yield broadcaster.broadcast(notify_args()[:-1], True)
+        for c in connections:
+            c.transport.written = 0
+
+        # RSK refresh, just the coinbase changes
+        refresh = list(notify_args()[:-1])
+        refresh[0] = '1a2c'
+        refresh[2] = '03' * 60
+        yield broadcaster.broadcast(tuple(refresh), False)
+        print "%-15s RSK refresh wrote %d bytes" % ('delta' if delta_notify else 'full', sum(c.transport.written for c in connections))
+
+    @defer.inlineCallbacks
+    def main():
+        try:
+            yield superseded()
+            yield ordered(False)
+            yield ordered(True)
+            yield delta(False)
+            yield delta(True)
+        finally:
+            reactor.stop()
+
+    reactor.callWhenRunning(main)
+    reactor.run()
+
+# Few big rigs and many small miners
+rnd = random.Random(0)
+now = time.time()
+for conn in connections:
+    conn.session['hashrate'] = HashrateEstimate()
+    conn.session['hashrate'].add(rnd.paretovariate(1.2), now)
+    for subscription in conn.session['subscriptions'].itervalues():
+        subscription.hashrate = conn.session['hashrate']
+
+Interfaces.set_timestamper(TimestamperInterface())
+run_chunked(connections)
@@ -0,0 +1,60 @@
+'''Cost of JSON decoding and encoding of Stratum messages by codecs
+of stratum.json_codec, which are selected by JSON_DECODER and JSON_ENCODER.
+
+Measures decoding of mining.submit and encoding of the submit response
+(precomputed by JsonCodec.response()), an error response, mining.notify
+and mining.subscribe response, for every installed codec.
+Run from the repository root: python tools/bench_json_codec.py'''
+
+import os
+import sys
+import time
+import argparse
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[0:0] = [os.path.join(root, 'conf'), root]
+
+from stratum.json_codec import JsonCodec
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--messages', type=int, default=200000, help='Number of messages per measurement')
+parser.add_argument('-b', '--branch', type=int, default=12, help='Length of merkle branch in mining.notify')
+args = parser.parse_args()
+
+def installed(name):
+    try:
+        __import__(name)
+        return True
+    except ImportError:
+        return False
+
+SUBMIT = '{"params": ["worker.1", "1a2b", "0000a1b2", "5b000000", "12345678"], "id": 12, "method": "mining.submit"}'
+NOTIFY = ['1a2b', 'ab' * 32, '01' * 60, '02' * 60, ['cd' * 32] * args.branch, '20000000', '1d00ffff', '5b000000', True]
+SUBSCRIBE = ((('mining.notify', 'ae6812eb4cd7735a302a8a9dd95cf71f'),), 'f8000001', 4)
+
+def messages(codec):
+    return (('submit decode', lambda: codec.loads(SUBMIT)),
+            ('submit true', lambda: codec.response(12, True)),
+            ('submit true dict', lambda: "%s\n" % codec.dumps({'id': 12, 'result': True, 'error': None})),
+            ('submit error', lambda: codec.error(12, -2, "Job '1a2b' not found", None)),
+            ('notify', lambda: codec.request(None, 'mining.notify', NOTIFY)),
+            ('subscribe', lambda: codec.response(1, SUBSCRIBE)))
+
+def measure(func):
+    start = time.time()
+    for _ in xrange(args.messages):
+        func()
+    return (time.time() - start) * 1e6 / args.messages
+
+codecs = [ name for name in ('json', 'simplejson', 'ujson') if installed(name) ]
+print "%-18s %s" % ('', ''.join("%12s" % name for name in codecs))
+
+results = dict((name, dict(messages(JsonCodec(name, name)))) for name in codecs)
+for (message, _) in messages(JsonCodec()):
+    print "%-18s %s" % (message, ''.join("%7.2f usec" % measure(results[name][message]) for name in codecs))
+
+reference = JsonCodec()
+for name in codecs:
+    codec = JsonCodec(name, name)
+    assert codec.loads(codec.response(7, True)) == reference.loads(reference.response(7, True))
+    assert codec.loads(codec.request(None, 'mining.notify', NOTIFY)) == reference.loads(reference.request(None, 'mining.notify', NOTIFY))
@@ -0,0 +1,141 @@
+'''Cost of receiving requests by stratum.protocol.Protocol.
+
+Replays a stream of submits of --connections connections, interleaved
+read by read, through Protocol.dataReceived() of connections with
+in-memory transports. Compares the request counter created for every
+read (as the HTTP transport still does) with the stream path of socket
+connections. Reads are either whole lines or pieces of random length
+up to --fragment bytes, like a slow client. The last replay sends
+one request of --payload bytes per connection in such pieces.
+
+Uses a captured client stream when given (the lines the clients sent,
+e.g. extracted from tcpflow output), otherwise a synthetic one of
+subscribe, authorize and --submits submits per connection.
+Run from the repository root: python tools/bench_line_receive.py [-f stream.txt]'''
+
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[0:0] = [os.path.join(root, 'conf'), root]
+
+from stratum.protocol import Protocol, RequestCounter
+from stratum.event_handler import GenericEventHandler
+
+# Connections and their count changes are logged on every replay
+logging.disable(logging.INFO)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-f', '--fixture', help='File with captured client lines, one request per line')
+parser.add_argument('-c', '--connections', type=int, default=10000, help='Number of replaying connections')
+parser.add_argument('-s', '--submits', type=int, default=20, help='Submits per connection in the synthetic stream')
+parser.add_argument('-F', '--fragment', type=int, default=64, help='Largest read of the fragmented replay')
+parser.add_argument('-p', '--payload', type=int, default=8000, help='Bytes of the big request')
+args = parser.parse_args()
+
+class Address(object):
+    host = '127.0.0.1'
+
+class Socket(object):
+    def setsockopt(self, *args):
+        pass
+
+class Transport(object):
+    disconnecting = False
+    socket = Socket()
+
+    def __init__(self):
+        self.written = 0
+
+    def setTcpNoDelay(self, enabled):
+        pass
+
+    def setTcpKeepAlive(self, enabled):
+        pass
+
+    def getPeer(self):
+        return Address()
+
+    def write(self, data):
+        self.written += len(data)
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+class EventHandler(GenericEventHandler):
+    def handle_event(self, msg_method, msg_params, connection_ref):
+        return True
+
+class Factory(object):
+    debug = False
+    event_handler = EventHandler
+
+def synthetic_stream(rnd):
+    lines = ['{"id": 1, "method": "mining.subscribe", "params": ["cgminer/4.10.0"]}',
+             '{"id": 2, "method": "mining.authorize", "params": ["worker.1", "x"]}']
+    for i in xrange(args.submits):
+        lines.append('{"params": ["worker.1", "%x", "%08x", "5b000000", "%08x"], "id": %d, "method": "mining.submit"}' % (
+            rnd.randint(0, 0xffff), rnd.getrandbits(32), rnd.getrandbits(32), i + 3))
+    return ''.join(line + '\n' for line in lines)
+
+def payload_stream(rnd):
+    return '{"id": 1, "method": "mining.suggest", "params": ["%s"]}\n' % ('ab' * (args.payload // 2))
+
+def split_lines(stream, rnd):
+    return [ line + '\n' for line in stream.split('\n')[:-1] ]
+
+def split_fragments(stream, rnd):
+    reads = []
+    i = 0
+    while i < len(stream):
+        size = rnd.randint(1, args.fragment)
+        reads.append(stream[i:i + size])
+        i += size
+    return reads
+
+def make_connection():
+    conn = Protocol()
+    conn.factory = Factory()
+    conn.transport = Transport()
+    conn.connectionMade()
+    return conn
+
+def replay(name, stream, split, counter):
+    rnd = random.Random(0)
+    connections = [ make_connection() for _ in xrange(args.connections) ]
+    reads = [ split(stream, rnd) for _ in xrange(args.connections) ]
+    total = sum(len(r) for r in reads)
+    lines = stream.count('\n') * args.connections
+
+    start = time.time()
+    for i in xrange(max(len(r) for r in reads)):
+        for (conn, r) in zip(connections, reads):
+            if i < len(r):
+                if counter:
+                    conn.dataReceived(r[i], RequestCounter())
+                else:
+                    conn.dataReceived(r[i])
+    elapsed = time.time() - start
+
+    written = sum(c.transport.written for c in connections)
+    print "%-10s %-14s %8d reads %8d requests %8.3f sec %6.2f usec/request, %d bytes answered" % (
+        name, 'RequestCounter' if counter else 'stream', total, lines, elapsed, elapsed * 1e6 / lines, written)
+
+    for conn in connections:
+        conn.connectionLost(None)
+
+if args.fixture:
+    with open(args.fixture) as f:
+        stream = ''.join(line.rstrip('\r\n') + '\n' for line in f if line.strip())
+else:
+    stream = synthetic_stream(random.Random(0))
+
+payload = payload_stream(random.Random(0))
+for (name, data, split) in (('lines', stream, split_lines), ('fragments', stream, split_fragments),
+                            ('payload', payload, split_fragments)):
+    replay(name, data, split, True)
+    replay(name, data, split, False)
@@ -0,0 +1,63 @@
+'''Cost of merkle branch computation on template refresh.
+
+Builds the tree of a template with --transactions transactions, changes
+the transaction list like a mempool refresh would and builds it again,
+without and with lib.merkletree.MerkleCache.
+Run from the repository root: python tools/bench_merkle.py'''
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from merkletree import MerkleTree, MerkleCache
+from util import doublesha
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-t', '--transactions', type=int, default=5000, help='Number of transactions in the template')
+parser.add_argument('-c', '--changes', type=int, default=10, help='Transactions added or removed by one refresh')
+parser.add_argument('-r', '--runs', type=int, default=50, help='Number of refreshes measured')
+args = parser.parse_args()
+
+rnd = random.Random(0)
+counter = [0]
+
+def new_hash():
+    counter[0] += 1
+    return doublesha(str(counter[0]))
+
+def unchanged(hashes):
+    return hashes
+
+def append(hashes):
+    return hashes + [new_hash() for _ in xrange(args.changes)]
+
+def remove_tail(hashes):
+    return hashes[:-args.changes]
+
+def remove_random(hashes):
+    hashes = list(hashes)
+    for _ in xrange(args.changes):
+        del hashes[rnd.randint(1, len(hashes) - 1)]
+    return hashes + [new_hash() for _ in xrange(args.changes)]
+
+def run(name, refresh, cache):
+    hashes = [None] + [new_hash() for _ in xrange(args.transactions)]
+    MerkleTree(list(hashes), cache=cache)
+
+    elapsed = 0
+    for _ in xrange(args.runs):
+        hashes = refresh(hashes)
+        start = time.time()
+        steps = MerkleTree(list(hashes), cache=cache)._steps
+        elapsed += time.time() - start
+        assert steps == MerkleTree(list(hashes))._steps
+
+    print "%-14s %-8s %8.3f ms per refresh" % (name, 'cached' if cache else 'full', elapsed * 1000 / args.runs)
+
+for (name, refresh) in (('unchanged', unchanged), ('append', append),
+                        ('remove_tail', remove_tail), ('remove_random', remove_random)):
+    run(name, refresh, None)
+    run(name, refresh, MerkleCache())
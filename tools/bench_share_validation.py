@@ -0,0 +1,130 @@
+'''Shares/sec of the share validation hashing path on one core.
+
+Builds a BlockTemplate from a synthetic getblocktemplate result and
+compares the original header construction (serialize_header + word swap)
+with the precomputed little endian header of the template. With -p,
+also ShareVerifierPool and CPU time its main process spends per share.
+Run from the repository root: python tools/bench_share_validation.py'''
+
+import os
+import sys
+import time
+import random
+import struct
+import binascii
+import argparse
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[0:0] = [os.path.join(root, 'conf'), root, os.path.join(root, 'lib')]
+
+from mining.interfaces import Interfaces, TimestamperInterface
+from lib.block_template import BlockTemplate
+from lib import util
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--shares', type=int, default=100000, help='Number of shares per run')
+parser.add_argument('-t', '--transactions', type=int, default=2000, help='Number of transactions in the template')
+parser.add_argument('-p', '--processes', type=int, default=0, help='Also measure ShareVerifierPool with this many worker processes')
+args = parser.parse_args()
+
+class Coinbaser(object):
+    def get_script_pubkey(self):
+        return util.script_to_address('mgjPZrmmpAVuetUBbokcaEm9uZqVAUFvAu')
+
+    def get_coinbase_data(self):
+        return ''
+
+def make_template(tx_count):
+    rnd = random.Random(0)
+    txs = []
+    for i in xrange(tx_count):
+        h = binascii.hexlify(struct.pack('>Q', rnd.getrandbits(64)) * 4)
+        txs.append({'data': '00', 'hash': h, 'txid': h})
+    data = {'transactions': txs, 'coinbasevalue': 1250000000, 'coinbaseaux': {'flags': ''},
+            'height': 500000, 'version': 0x20000000, 'previousblockhash': '00' * 4 + 'ab' * 28,
+            'bits': '1d00ffff', 'curtime': int(time.time()), 'rsk_header': None}
+
+    template = BlockTemplate(Interfaces.timestamper, Coinbaser(), '1')
+    template.fill_from_rpc(data)
+    return template
+
+def old_path(job, extranonce1_bin, extranonce2_bin, ntime_bin, nonce_bin):
+    coinbase_hash = util.doublesha(job.serialize_coinbase(extranonce1_bin, extranonce2_bin))
+    merkle_root_bin = job.merkletree.withFirst(coinbase_hash)
+    merkle_root_int = util.uint256_from_str(merkle_root_bin)
+    header_bin = job.serialize_header(merkle_root_int, ntime_bin, nonce_bin)
+    header_le = ''.join([header_bin[i*4:i*4+4][::-1] for i in range(0, 20)])
+    return util.uint256_from_str(util.doublesha(header_le))
+
+def new_path(job, extranonce1_bin, extranonce2_bin, ntime_bin, nonce_bin):
+    coinbase_hash = util.doublesha(job.serialize_coinbase(extranonce1_bin, extranonce2_bin))
+    merkle_root_bin = job.merkletree.withFirst(coinbase_hash)
+    header_le = job.serialize_header_le(merkle_root_bin, ntime_bin, nonce_bin)
+    return util.uint256_from_str(util.doublesha(header_le))
+
+def report(name, shares, elapsed):
+    print "%-10s %8d shares %8.3f sec %10.0f shares/sec" % (name, shares, elapsed, shares / elapsed)
+
+def run(name, func, job, shares):
+    extranonce1_bin = struct.pack('>L', 0xf8000001)
+    ntime_bin = struct.pack('>I', job.curtime)
+    start = time.time()
+    for i in xrange(shares):
+        func(job, extranonce1_bin, struct.pack('>L', i >> 16), ntime_bin, struct.pack('>L', i))
+    report(name, shares, time.time() - start)
+
+def run_pool(processes, job, shares):
+    '''Wall clock rate is limited by the cores of the machine. CPU time of
+    the main process per share (sending shares, receiving results, firing
+    Deferreds) limits the rate the pool reaches with a core per worker.'''
+    from twisted.internet import reactor, defer
+    from lib.share_verifier import ShareVerifierPool
+
+    pool = ShareVerifierPool(processes)
+    pool.add_job(job)
+
+    def start():
+        # Many connections, shares are spread between workers by extranonce1
+        extranonce1s = [ struct.pack('>L', 0xf8000000 + i) for i in xrange(1000) ]
+        ntime = '%08x' % job.curtime
+        started = time.time()
+        cpu = sum(os.times()[:2])
+        ds = []
+        for first in xrange(0, shares, 1000):
+            # Shares of one reactor iteration
+            reactor.callLater(0, lambda first=first: ds.extend(
+                pool.verify(job.job_id, extranonce1s[i % 1000], '%08x' % (i >> 16), ntime, '%08x' % i)
+                for i in xrange(first, min(first + 1000, shares))))
+
+        def check():
+            if len(ds) < shares:
+                reactor.callLater(0.01, check)
+                return
+            defer.DeferredList(ds).addCallback(done)
+
+        def done(results):
+            assert all(ok and error is None for (ok, (error, _, _)) in results)
+            elapsed = time.time() - started
+            main_cpu = sum(os.times()[:2]) - cpu
+            report('pool(%d)' % processes, shares, elapsed)
+            print "%-10s %8.2f usec main process CPU per share, it saturates at %.0f shares/sec" % \
+                  ('', main_cpu * 1e6 / shares, shares / main_cpu)
+            reactor.stop()
+        check()
+
+    reactor.callWhenRunning(start)
+    reactor.run()
+
+Interfaces.set_timestamper(TimestamperInterface())
+job = make_template(args.transactions)
+
+# Both paths must agree before we compare their speed
+for i in xrange(100):
+    params = (struct.pack('>L', 1), struct.pack('>L', i), struct.pack('>I', job.curtime), struct.pack('>L', i * 7))
+    assert old_path(job, *params) == new_path(job, *params)
+
+run('old', old_path, job, args.shares)
+run('new', new_path, job, args.shares)
+
+if args.processes:
+    run_pool(args.processes, job, args.shares)
@@ -0,0 +1,51 @@
+'''Per-share cost of duplicate detection as the number of submits grows.
+
+Compares the old list based check with lib.submit_index.SubmitIndex.
+Run from the repository root: python tools/bench_submit_index.py'''
+
+import os
+import sys
+import struct
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from submit_index import SubmitIndex
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-l', '--list-max', type=int, default=20000, help='Largest template size measured for the old list check')
+parser.add_argument('-m', '--max', type=int, default=1000000, help='Largest template size measured for SubmitIndex')
+parser.add_argument('-b', '--bloom-limit', type=int, default=200000, help='Exact entries before spilling to the bloom filter')
+args = parser.parse_args()
+
+def share(i):
+    # extranonce1, extranonce2, ntime, nonce
+    return (struct.pack('>L', 0xf8000000 + (i & 0xff)), struct.pack('>L', i >> 8),
+            '\x5b\x00\x00\x00', struct.pack('>L', (i * 2654435761) & 0xffffffff))
+
+def run_list(count):
+    submits = []
+    start = time.time()
+    for i in xrange(count):
+        t = share(i)
+        if t not in submits:
+            submits.append(t)
+    return time.time() - start
+
+def run_index(count, index):
+    start = time.time()
+    for i in xrange(count):
+        (e1, e2, ntime, nonce) = share(i)
+        index.add(e1 + e2 + ntime + nonce)
+    return time.time() - start
+
+def report(name, count, elapsed):
+    print "%-22s %8d submits %8.3f sec %8.2f usec/share" % (name, count, elapsed, elapsed * 1e6 / count)
+
+count = 1000
+while count <= args.max:
+    if count <= args.list_max:
+        report('list', count, run_list(count))
+    report('SubmitIndex', count, run_index(count, SubmitIndex()))
+    report('SubmitIndex+bloom', count, run_index(count, SubmitIndex(args.bloom_limit, 2**25)))
+    count *= 10
@@ -0,0 +1,105 @@
+'''Cost of building block templates from a large getblocktemplate result.
+
+Compares decoding of transaction data into every template with TxBlob,
+which decodes it once per getblocktemplate result and is shared by all
+templates built from it (e.g. RSK refreshes), and checks
+BlockTemplate.serialize_hex() against hexlify(serialize()).
+
+Uses a recorded getblocktemplate result when given, e.g.
+  bitcoin-cli getblocktemplate '{"rules": ["segwit"]}' > gbt.json
+otherwise a synthetic one of about --size bytes of transactions.
+Both are measured as decoded by json.loads, like the RPC result.
+Run from the repository root: python tools/bench_template_build.py [-f gbt.json]'''
+
+import os
+import sys
+import json
+import time
+import random
+import binascii
+import argparse
+import hashlib
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[0:0] = [os.path.join(root, 'conf'), root, os.path.join(root, 'lib')]
+
+from mining.interfaces import Interfaces, TimestamperInterface
+from lib.block_template import BlockTemplate, TxBlob
+from lib import util
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-f', '--fixture', help='JSON file with recorded getblocktemplate result')
+parser.add_argument('-s', '--size', type=int, default=4000000, help='Bytes of transactions in the synthetic template')
+parser.add_argument('-r', '--runs', type=int, default=10, help='Number of templates built per measurement')
+args = parser.parse_args()
+
+class Coinbaser(object):
+    def get_script_pubkey(self):
+        return util.script_to_address('mgjPZrmmpAVuetUBbokcaEm9uZqVAUFvAu')
+
+    def get_coinbase_data(self):
+        return ''
+
+def synthetic_template(size):
+    rnd = random.Random(0)
+    txs = []
+    total = 0
+    while total < size:
+        tx = ''.join(chr(rnd.getrandbits(8)) for _ in xrange(rnd.randint(200, 800)))
+        h = hashlib.sha256(hashlib.sha256(tx).digest()).digest()[::-1].encode('hex')
+        txs.append({'data': binascii.hexlify(tx), 'hash': h, 'txid': h})
+        total += len(tx)
+
+    data = {'transactions': txs, 'coinbasevalue': 1250000000, 'coinbaseaux': {'flags': ''},
+            'height': 500000, 'version': 0x20000000, 'previousblockhash': '00' * 4 + 'ab' * 28,
+            'bits': '1d00ffff', 'curtime': int(time.time())}
+    return json.loads(json.dumps(data))
+
+def eager_decode(data):
+    # What fill_from_rpc used to do for every template
+    return [ binascii.unhexlify(tx['data']) for tx in data['transactions'] ]
+
+def shared_decode(data):
+    # What TemplateTransactions does once per getblocktemplate result
+    return [ TxBlob(tx['data']) for tx in data['transactions'] ]
+
+def held_size(x):
+    if isinstance(x, TxBlob):
+        return sys.getsizeof(x) + sys.getsizeof(x.data)
+    return sys.getsizeof(x)
+
+def measure(name, func, data):
+    start = time.time()
+    for _ in xrange(args.runs):
+        result = func(data)
+    elapsed = (time.time() - start) / args.runs
+    held = sum(held_size(x) for x in result) + sys.getsizeof(result)
+    print "%-8s %8.2f ms per template %10d bytes held per template" % (name, elapsed * 1000, held)
+
+Interfaces.set_timestamper(TimestamperInterface())
+
+if args.fixture:
+    with open(args.fixture) as f:
+        data = json.load(f)
+else:
+    data = synthetic_template(args.size)
+data['rsk_header'] = None
+
+print "%d transactions, %d bytes" % (len(data['transactions']), sum(len(tx['data']) // 2 for tx in data['transactions']))
+
+measure('eager', eager_decode, data)
+measure('shared', shared_decode, data)
+
+template = BlockTemplate(Interfaces.timestamper, Coinbaser(), '1')
+template.fill_from_rpc(data)
+template.finalize(0, '\0' * 4, '\0' * 4, data['curtime'], 0)
+
+start = time.time()
+old = binascii.hexlify(template.serialize())
+print "hexlify(serialize()) %8.2f ms" % ((time.time() - start) * 1000)
+
+start = time.time()
+new = template.serialize_hex()
+print "serialize_hex()      %8.2f ms" % ((time.time() - start) * 1000)
+
+assert old == new and type(new) is str
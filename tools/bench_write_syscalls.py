@@ -0,0 +1,183 @@
+'''Syscalls and latency of writing to socket transport connections.
+
+Connects --connections clients over localhost. In every one of --bursts
+reactor iterations, each server connection writes set_difficulty,
+mining.notify and a response, like during a broadcast, and the number
+of send() and epoll_ctl() calls of the server sockets is counted until
+the clients receive it. Twisted sends all writes of one iteration
+by one send(), so it stays at one send() and two epoll_ctl() per
+connection, however many lines are written. Then one client sends
+--requests requests one after another and the round trip times
+are measured.
+Run from the repository root: python tools/bench_write_syscalls.py'''
+
+import os
+import sys
+import time
+import logging
+import argparse
+import collections
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[0:0] = [os.path.join(root, 'conf'), root]
+
+from twisted.internet import epollreactor
+epollreactor.install()
+from twisted.internet import reactor, defer, protocol, tcp
+
+from stratum.protocol import Protocol
+from stratum.socket_transport import SocketTransportFactory
+from stratum.event_handler import GenericEventHandler
+
+# Connections and notifications are logged otherwise
+logging.disable(logging.INFO)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-c', '--connections', type=int, default=500, help='Number of connections')
+parser.add_argument('-b', '--bursts', type=int, default=20, help='Reactor iterations writing to all connections')
+parser.add_argument('-r', '--requests', type=int, default=5000, help='Requests of the latency measurement')
+args = parser.parse_args()
+
+server_fds = set()
+counts = collections.Counter()
+
+class CountingPoller(object):
+    '''Counts epoll_ctl calls of server sockets.'''
+    def __init__(self, poller):
+        self.poller = poller
+
+    def _count(self, fd):
+        if fd in server_fds:
+            counts['epoll_ctl'] += 1
+
+    def register(self, fd, flags):
+        self._count(fd)
+        return self.poller.register(fd, flags)
+
+    def modify(self, fd, flags):
+        self._count(fd)
+        return self.poller.modify(fd, flags)
+
+    def unregister(self, fd):
+        self._count(fd)
+        return self.poller.unregister(fd)
+
+    def poll(self, *args):
+        return self.poller.poll(*args)
+
+    def fileno(self):
+        return self.poller.fileno()
+
+    def close(self):
+        return self.poller.close()
+
+reactor._poller = CountingPoller(reactor._poller)
+
+_writeSomeData = tcp.Connection.writeSomeData
+def writeSomeData(self, data):
+    if self.fileno() in server_fds:
+        counts['send'] += 1
+    return _writeSomeData(self, data)
+tcp.Connection.writeSomeData = writeSomeData
+
+class EventHandler(GenericEventHandler):
+    def handle_event(self, msg_method, msg_params, connection_ref):
+        return True
+
+class ServerProtocol(Protocol):
+    def connectionMade(self):
+        Protocol.connectionMade(self)
+        server_fds.add(self.transport.fileno())
+        self.factory.connections.append(self)
+
+class Client(protocol.Protocol):
+    def connectionMade(self):
+        self.factory.clients.append(self)
+        if len(self.factory.clients) == args.connections:
+            self.factory.on_connected.callback(None)
+
+    def dataReceived(self, data):
+        self.factory.received(self, data.count('\n'))
+
+class ClientFactory(protocol.ClientFactory):
+    protocol = Client
+
+    def __init__(self):
+        self.clients = []
+        self.on_connected = defer.Deferred()
+        self.expected = 0
+        self.on_received = None
+
+    def received(self, client, lines):
+        self.expected -= lines
+        if self.expected <= 0 and self.on_received is not None:
+            (d, self.on_received) = (self.on_received, None)
+            d.callback(None)
+
+    def expect(self, lines):
+        self.expected += lines
+        self.on_received = defer.Deferred()
+        return self.on_received
+
+NOTIFY = ['1a2b', 'ab' * 32, '01' * 60, '02' * 60, ['cd' * 32] * 12, '20000000', '1d00ffff', '5b000000', True]
+
+@defer.inlineCallbacks
+def run():
+    factory = SocketTransportFactory(event_handler=EventHandler)
+    factory.protocol = ServerProtocol
+    factory.connections = []
+    port = reactor.listenTCP(0, factory, backlog=args.connections, interface='127.0.0.1')
+
+    clients = ClientFactory()
+    for _ in xrange(args.connections):
+        reactor.connectTCP('127.0.0.1', port.getHost().port, clients)
+    yield clients.on_connected
+    while len(factory.connections) < args.connections:
+        d = defer.Deferred()
+        reactor.callLater(0.01, d.callback, None)
+        yield d
+
+    counts.clear()
+    elapsed = 0
+    for _ in xrange(args.bursts):
+        d = clients.expect(3 * args.connections)
+        start = time.time()
+        for conn in factory.connections:
+            conn.writeJsonRequest('mining.set_difficulty', [1024], is_notification=True)
+            conn.writeJsonRequest('mining.notify', NOTIFY, is_notification=True)
+            conn.writeJsonResponse(True, 1)
+        yield d
+        elapsed += time.time() - start
+    writes = 3 * args.connections * args.bursts
+    print "%6d writes %6d send %6d epoll_ctl %6.2f syscalls per connection and burst, burst delivered in %.3f sec" % (
+        writes, counts['send'], counts['epoll_ctl'],
+        float(counts['send'] + counts['epoll_ctl']) / args.connections / args.bursts, elapsed / args.bursts)
+
+    client = clients.clients[0]
+    counts.clear()
+    rtt = []
+    for i in xrange(args.requests):
+        d = clients.expect(1)
+        start = time.time()
+        client.transport.write('{"id": %d, "method": "mining.submit", "params": ["w", "1a2b", "00000000", "5b000000", "00000000"]}\n' % i)
+        yield d
+        rtt.append(time.time() - start)
+    rtt.sort()
+    print "%6d requests %6d send %6d epoll_ctl, round trip p50 %.1f p99 %.1f max %.1f usec" % (
+        args.requests, counts['send'], counts['epoll_ctl'],
+        rtt[len(rtt) // 2] * 1e6, rtt[len(rtt) * 99 // 100] * 1e6, rtt[-1] * 1e6)
+
+    for c in clients.clients:
+        c.transport.loseConnection()
+    yield port.stopListening()
+    server_fds.clear()
+
+@defer.inlineCallbacks
+def main():
+    try:
+        yield run()
+    finally:
+        reactor.stop()
+
+reactor.callWhenRunning(main)
+reactor.run()